@@ -0,0 +1,79 @@
+from SheetReader import SheetReader
+from paths import replaced_atomically
+
+
+class ArrowReader(SheetReader):
+    PARQUET_EXTENSIONS = ('.parquet', '.pq')
+
+    def load_data(self):
+        table = self.__read_table()
+        self.set_headers(table.column_names)
+
+        # Columns are decoded by Arrow as a whole; only text columns that hold typed fields are converted here
+        columns = [self.mapping.convert(self.mapping.field(header), table.column(header).to_pylist())
+                   for header in self.headers]
+        rows = [list(row) for row in zip(*columns)] if columns else []
+        client_idx = self.index_of('client')
+        for row_index, row in enumerate(rows):
+            # Stop reading at the first row without a client, like the workbook reader
+            if client_idx is None or row[client_idx] is None:
+                rows = rows[:row_index]
+                break
+        self.data = rows
+        self.row_count = len(self.data)
+
+    def save_data(self):
+        pyarrow = self.__pyarrow()
+        try:
+            table = self.__read_table()
+            invoice_header = self.mapping.header('invoice')
+            if invoice_header in table.column_names:
+                invoice = table.column(invoice_header).to_pylist()
+            else:
+                invoice = [None] * table.num_rows
+            for row_index in self.dirty_rows:
+                invoice[row_index] = True
+            column = pyarrow.array(invoice, type=pyarrow.bool_())
+            if invoice_header in table.column_names:
+                table = table.set_column(table.column_names.index(invoice_header), invoice_header, column)
+            else:
+                table = table.append_column(invoice_header, column)
+
+            # Written next to the original and swapped in, so a crash mid-save cannot corrupt the file
+            with replaced_atomically(self.file_path) as temp_path:
+                if self.__is_parquet():
+                    import pyarrow.parquet
+                    pyarrow.parquet.write_table(table, temp_path)
+                else:
+                    import pyarrow.feather
+                    pyarrow.feather.write_feather(table, temp_path)
+            return True
+        except Exception as e:
+            self.logger.error("An unexpected error occurred while saving: %s", e)
+            return False
+
+    def __read_table(self):
+        self.__pyarrow()
+        try:
+            if self.__is_parquet():
+                import pyarrow.parquet
+                return pyarrow.parquet.read_table(self.file_path)
+            import pyarrow.feather
+            return pyarrow.feather.read_table(self.file_path)
+        except FileNotFoundError:
+            self.logger.error("Error: File not found: %s", self.file_path)
+            exit(-1)
+        except Exception as e:
+            self.logger.error("An unexpected error occurred: %s", e)
+            exit(-1)
+
+    def __is_parquet(self):
+        return self.file_path.lower().endswith(self.PARQUET_EXTENSIONS)
+
+    @staticmethod
+    def __pyarrow():
+        try:
+            import pyarrow
+        except ImportError as e:
+            raise RuntimeError("Reading Parquet or Arrow files requires pyarrow (pip install pyarrow)") from e
+        return pyarrow
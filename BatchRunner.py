@@ -0,0 +1,110 @@
+import glob
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from ColumnMapping import ColumnMapping
+from GreenInvoiceHandler import GreenInvoiceHandler
+from invoiceApp import InvoiceApp
+from Session import Session
+from PreviewCache import PreviewCache
+from logger import Logger
+from readers import SUPPORTED_EXTENSIONS
+
+FileResult = namedtuple('FileResult', ['file_path', 'result', 'seconds'])
+
+
+class BatchRunner:
+    PARALLEL_FILES = 2
+
+    def __init__(self, command, pattern, parallel_files=PARALLEL_FILES, streaming=False, workers=1, rate_limit=None,
+                 prefetch_clients=False, resume=False, preview_dir=GreenInvoiceHandler.PREVIEW_DIRECTORY,
+                 preview_output=None, base_url=GreenInvoiceHandler.BASE_URL, metrics_output=None, reconcile=True,
+                 column_mapping=None, preview_cache_size=PreviewCache.MAX_BYTES):
+        self.logger = Logger.get_logger(__name__)
+        self.command = command
+        self.file_paths = self.find_workbooks(pattern)
+        self.parallel_files = max(1, parallel_files)
+        self.app_options = {'streaming': streaming, 'workers': workers, 'resume': resume,
+                            'preview_dir': preview_dir, 'reconcile': reconcile,
+                            # Loaded once, every file of the batch shares the same headers
+                            'column_mapping': ColumnMapping.load(column_mapping) if isinstance(column_mapping, str)
+                            else column_mapping}
+        self.preview_output = preview_output
+        self.metrics_output = metrics_output
+        # One token, client cache, rate limiter and connection pool for every workbook, the pool sized for all
+        # files running at once
+        self.session = Session(base_url=base_url, pool_size=self.parallel_files * max(1, workers),
+                               rate_limit=rate_limit, prefetch_clients=prefetch_clients, preview_dir=preview_dir,
+                               preview_cache_size=preview_cache_size)
+        self.metrics = self.session.metrics
+        self.results = []
+
+    @staticmethod
+    def find_workbooks(pattern):
+        if os.path.isdir(pattern):
+            # Every file a reader exists for, state files such as .journal and .pending are left out
+            paths = [path for path in glob.glob(os.path.join(pattern, '*'))
+                     if path.lower().endswith(SUPPORTED_EXTENSIONS)]
+        else:
+            paths = glob.glob(pattern)
+        # Excel keeps a ~$ lock file next to every open workbook
+        return sorted(path for path in paths if not os.path.basename(path).startswith('~$'))
+
+    def run(self):
+        if not self.file_paths:
+            self.logger.error("No workbooks to process")
+            return []
+        self.logger.info("Processing %s workbooks, %s at a time", len(self.file_paths), self.parallel_files)
+        self.session.connect_or_exit()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.parallel_files) as executor:
+                self.results = list(executor.map(self.__run_file, self.file_paths))
+        finally:
+            self.session.save()
+        self.session.report(self.metrics_output, 'Batch results', self.summary())
+        return self.results
+
+    def missing_clients(self):
+        missing = set()
+        for file_result in self.results:
+            if isinstance(file_result.result, set):
+                missing.update(file_result.result)
+        return missing
+
+    def summary(self):
+        width = max([len('workbook')] + [len(os.path.basename(path)) for path in self.file_paths])
+        header = f"{'workbook':<{width}} {'seconds':>8}  result"
+        lines = [header, '-' * len(header)]
+        for file_result in self.results:
+            result = file_result.result
+            if isinstance(result, set):
+                result = f"{len(result)} missing clients" if result else f"{self.command} completed successfully"
+            lines.append(f"{os.path.basename(file_result.file_path):<{width}} {file_result.seconds:>8.2f}  "
+                         f"{result.splitlines()[0]}")
+        return "\n".join(lines)
+
+    def __run_file(self, file_path):
+        start = time.perf_counter()
+        app = InvoiceApp(self.command, file_path, preview_output=self.__preview_output(file_path),
+                         session=self.session, **self.app_options)
+        try:
+            result = app.run()
+        except SystemExit:
+            # InvoiceApp stops on an unreadable workbook or an invoice issued out of order, which only ends
+            # this workbook
+            result = f"{self.command} stopped, see the log for details"
+        except Exception as e:
+            self.logger.error("%s failed on %s: %s", self.command, file_path, e)
+            result = f"{self.command} failed: {e}"
+        return FileResult(file_path, result, time.perf_counter() - start)
+
+    def __preview_output(self, file_path):
+        if not self.preview_output:
+            return None
+        # One archive per workbook, named after it
+        root, extension = os.path.splitext(self.preview_output)
+        workbook = os.path.splitext(os.path.basename(file_path))[0]
+        return f"{root}_{workbook}{extension}"
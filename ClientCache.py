@@ -0,0 +1,82 @@
+import json
+import threading
+import time
+
+from logger import Logger
+from paths import replaced_atomically
+
+
+class ClientCache:
+    TTL = 7 * 24 * 60 * 60  # seconds
+
+    def __init__(self, cache_path=None, ttl=TTL):
+        self.logger = Logger.get_logger(__name__)
+        self.cache_path = cache_path
+        self.ttl = ttl
+        # name -> (id, email, resolved_at)
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.__load()
+
+    def get(self, name):
+        with self.lock:
+            entry = self.clients.get(name)
+            if entry is None:
+                return None
+            if time.time() - entry[2] > self.ttl:
+                del self.clients[name]
+                self.dirty = True
+                return None
+            return entry[0], entry[1]
+
+    def put(self, name, id_value, email=None):
+        with self.lock:
+            self.clients[name] = (id_value, email, time.time())
+            self.dirty = True
+
+    def replace_all(self, clients):
+        resolved_at = time.time()
+        with self.lock:
+            self.clients = {name: (id_value, email, resolved_at) for name, (id_value, email) in clients.items()}
+            self.dirty = True
+
+    def invalidate(self, name=None):
+        with self.lock:
+            if name is None:
+                self.clients.clear()
+            else:
+                self.clients.pop(name, None)
+            self.dirty = True
+
+    def save(self):
+        if not self.cache_path:
+            return
+        with self.lock:
+            if not self.dirty:
+                return
+            snapshot = {name: list(entry) for name, entry in self.clients.items()}
+            self.dirty = False
+        try:
+            with replaced_atomically(self.cache_path) as temp_path:
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(snapshot, f, ensure_ascii=False)
+            self.logger.debug("Saved %s clients to %s", len(snapshot), self.cache_path)
+        except OSError as e:
+            self.logger.error("Could not save client cache: %s", e)
+
+    def __load(self):
+        if not self.cache_path:
+            return
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.logger.warning("Ignoring unreadable client cache %s: %s", self.cache_path, e)
+            return
+
+        now = time.time()
+        self.clients = {name: tuple(entry) for name, entry in stored.items() if now - entry[2] <= self.ttl}
+        self.logger.debug("Loaded %s clients from %s", len(self.clients), self.cache_path)
@@ -0,0 +1,109 @@
+import json
+from datetime import datetime
+
+
+class ColumnMapping:
+    SHEET_NAME = 'EFT & Paybox'
+    DATE_FORMAT = '%Y-%m-%d'
+    # Field the app asks for -> header in the input file, the defaults match the 'EFT & Paybox' sheet
+    COLUMNS = {
+        'client': 'Client',
+        'invoice': 'Invoice',
+        'date_paid': 'Date Paid',
+        'amount_paid': 'Amount Paid',
+        'number_of_apts': 'Number of Apts',
+        'treatment': 'Treatment',
+        'bank': 'Bank',
+        'bank_branch': 'Bank Branch ',
+        'account': 'Account #',
+        'bit': 'Bit',
+        'paybox': 'Paybox',
+        'eft': 'EFT',
+        'cash': 'Cash',
+    }
+    # How text cells are typed, so CSV and string columns give the values openpyxl reads from a workbook
+    FIELD_TYPES = {
+        'invoice': 'bool',
+        'date_paid': 'date',
+        'amount_paid': 'number',
+        'number_of_apts': 'number',
+        # Identifiers rather than quantities, leading zeros are kept
+        'bank': 'text',
+        'bank_branch': 'text',
+        'account': 'text',
+        'bit': 'bool',
+        'paybox': 'bool',
+        'eft': 'bool',
+        'cash': 'bool',
+    }
+    FALSE_VALUES = ('', '0', 'false', 'no', 'n')
+
+    def __init__(self, columns=None, sheet_name=SHEET_NAME, date_format=DATE_FORMAT):
+        self.columns = dict(self.COLUMNS, **(columns or {}))
+        self.sheet_name = sheet_name
+        self.date_format = date_format
+
+    @classmethod
+    def load(cls, mapping_path):
+        # YAML or JSON: {sheet: ..., date_format: ..., columns: {client: 'Patient', ...}}, every key optional
+        with open(mapping_path, 'r', encoding='utf-8') as f:
+            if mapping_path.endswith('.json'):
+                config = json.load(f)
+            else:
+                import yaml
+                config = yaml.safe_load(f)
+        config = config or {}
+        unknown = set(config.get('columns') or {}) - set(cls.COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown fields in {mapping_path}: {', '.join(sorted(unknown))}")
+        return cls(config.get('columns'), sheet_name=config.get('sheet', cls.SHEET_NAME),
+                   date_format=config.get('date_format', cls.DATE_FORMAT))
+
+    def header(self, field):
+        return self.columns[field]
+
+    def field(self, header):
+        for field, mapped in self.columns.items():
+            if mapped == header:
+                return field
+        return None
+
+    def convert(self, field, values):
+        # Types a whole column of text at once; anything that is not text is left as the reader gave it
+        field_type = self.FIELD_TYPES.get(field)
+        if field_type is None:
+            return [value if value != '' else None for value in values]
+        converter = {'bool': self.__to_bool, 'date': self.__to_date, 'number': self.__to_number,
+                     'text': self.__to_text}[field_type]
+        return [converter(value) if isinstance(value, str) else value for value in values]
+
+    def __to_bool(self, value):
+        value = value.strip()
+        if value.lower() in self.FALSE_VALUES:
+            return None
+        return True
+
+    def __to_date(self, value):
+        value = value.strip()
+        if not value:
+            return None
+        try:
+            return datetime.strptime(value, self.date_format)
+        except ValueError:
+            # Left as text, the row is then reported as invalid
+            return value
+
+    @staticmethod
+    def __to_text(value):
+        return value.strip() or None
+
+    @staticmethod
+    def __to_number(value):
+        value = value.strip().replace(',', '')
+        if not value:
+            return None
+        try:
+            number = float(value)
+        except ValueError:
+            return value
+        return int(number) if number.is_integer() else number
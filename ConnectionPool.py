@@ -0,0 +1,172 @@
+import gzip
+import http.client
+import io
+import queue
+import select
+import threading
+import zlib
+from collections import namedtuple
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+
+from logger import Logger
+
+Response = namedtuple('Response', ['status', 'headers', 'body'])
+
+
+class StreamedBody:
+    def __init__(self, response, release):
+        self.response = response
+        self.release = release
+        encoding = (response.getheader('Content-Encoding') or '').lower()
+        self.reader = gzip.GzipFile(fileobj=response) if encoding == 'gzip' else response
+        self.closed = False
+
+    def read(self, size=-1):
+        try:
+            return self.reader.read(size)
+        except (OSError, EOFError, zlib.error) as e:
+            if isinstance(e, http.client.HTTPException):
+                raise
+            # A body cut off mid-stream fails like any incomplete read
+            raise http.client.HTTPException(f"Could not read the response: {e}") from e
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # The connection can only be reused once the whole body was consumed
+        self.release(self.response.isclosed() and not self.response.will_close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ConnectionPool:
+    POOL_SIZE = 4
+    TIMEOUT = 30  # seconds
+
+    def __init__(self, base_url, pool_size=POOL_SIZE, timeout=TIMEOUT):
+        self.logger = Logger.get_logger(__name__)
+        url = urlsplit(base_url)
+        self.base_url = base_url.rstrip('/')
+        self.secure = url.scheme == 'https'
+        self.host = url.hostname
+        self.port = url.port
+        self.base_path = url.path.rstrip('/')
+        self.timeout = timeout
+        # Idle keep-alive connections; the semaphore bounds how many are open at once
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(pool_size)
+
+    def request(self, method, end_point, body=None, headers=None, stream=False, idempotent=False):
+        # With stream=True a successful response body is returned as a file-like StreamedBody, which keeps
+        # its connection until it is closed. Only idempotent requests are sent again once they reached the server.
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', 'gzip' if stream else 'gzip, deflate')
+        headers.setdefault('Connection', 'keep-alive')
+
+        self.slots.acquire()
+        connection = None
+        try:
+            connection, reused = self.__acquire()
+            try:
+                connection.request(method, self.base_path + end_point, body=body, headers=headers)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                if not reused:
+                    raise
+                # The server dropped an idle keep-alive connection before the request was sent, reconnect once
+                self.logger.debug("Stale connection to %s, reconnecting", self.host)
+                connection, reused = self.__new_connection(), False
+                connection.request(method, self.base_path + end_point, body=body, headers=headers)
+            try:
+                response = self.__receive(connection, stream)
+            except (http.client.RemoteDisconnected, ConnectionResetError):
+                connection.close()
+                # The request was sent and may have been processed, e.g. a document issued, before the connection
+                # dropped
+                if not (reused and idempotent):
+                    raise
+                self.logger.debug("Connection to %s dropped before the response, sending again", self.host)
+                connection = self.__new_connection()
+                connection.request(method, self.base_path + end_point, body=body, headers=headers)
+                response = self.__receive(connection, stream)
+        except Exception:
+            if connection is not None:
+                connection.close()
+            self.slots.release()
+            raise
+
+        if stream and response.status < 400:
+            return Response(response.status, response.headers,
+                            StreamedBody(response, lambda reusable: self.__release(connection, reusable)))
+        self.__release(connection, not response.will_close)
+
+        status, response_headers, response_body = response.status, response.headers, response.body
+        if status >= 400:
+            raise HTTPError(self.base_url + end_point, status, response.reason, response_headers,
+                            io.BytesIO(response_body))
+        return Response(status, response_headers, response_body)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def __release(self, connection, reusable):
+        if reusable:
+            self.idle.put(connection)
+        else:
+            connection.close()
+        self.slots.release()
+
+    def __acquire(self):
+        while True:
+            try:
+                connection = self.idle.get_nowait()
+            except queue.Empty:
+                return self.__new_connection(), False
+            if not self.__dropped(connection):
+                return connection, True
+            connection.close()
+
+    @staticmethod
+    def __dropped(connection):
+        # An idle connection has nothing to read, unless the server closed it meanwhile
+        if connection.sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([connection.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def __new_connection(self):
+        if self.secure:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def __receive(self, connection, stream=False):
+        response = connection.getresponse()
+        if not stream or response.status >= 400:
+            # Read the whole body so the connection can be handed back to the pool
+            response.body = self.__decode(response, response.read())
+        return response
+
+    @staticmethod
+    def __decode(response, body):
+        encoding = (response.getheader('Content-Encoding') or '').lower()
+        try:
+            if encoding == 'gzip':
+                return gzip.decompress(body)
+            if encoding == 'deflate':
+                return zlib.decompress(body)
+        except (OSError, EOFError, zlib.error) as e:
+            raise http.client.HTTPException(f"Could not decode the {encoding} response: {e}") from e
+        return body
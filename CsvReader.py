@@ -0,0 +1,77 @@
+import codecs
+import csv
+
+from SheetReader import SheetReader
+from paths import replaced_atomically
+
+
+class CsvReader(SheetReader):
+    # Excel and most booking systems export with a BOM, others without; a file is saved the way it was read
+    BOM_ENCODING = 'utf-8-sig'
+    ENCODING = 'utf-8'
+
+    def load_data(self):
+        try:
+            self.encoding = self.__encoding()
+            with open(self.file_path, 'r', encoding=self.encoding, newline='') as f:
+                reader = csv.reader(f, self.__dialect(f))
+                self.set_headers(next(reader, []))
+                raw_rows = []
+                client_idx = self.index_of('client')
+                for row in reader:
+                    # Stop reading at the first row without a client, like the workbook reader
+                    if client_idx is None or client_idx >= len(row) or not row[client_idx].strip():
+                        break
+                    raw_rows.append(row + [''] * (len(self.headers) - len(row)))
+        except FileNotFoundError:
+            self.logger.error("Error: File not found: %s", self.file_path)
+            exit(-1)
+        except (OSError, csv.Error, UnicodeDecodeError) as e:
+            self.logger.error("An unexpected error occurred: %s", e)
+            exit(-1)
+
+        # Every column is typed in one pass over the column instead of cell by cell per row
+        columns = []
+        for col_idx, header in enumerate(self.headers):
+            values = [row[col_idx] for row in raw_rows]
+            columns.append(self.mapping.convert(self.mapping.field(header), values))
+        self.data = [list(row) for row in zip(*columns)] if columns else []
+        self.row_count = len(self.data)
+
+    def __encoding(self):
+        with open(self.file_path, 'rb') as f:
+            return self.BOM_ENCODING if f.read(len(codecs.BOM_UTF8)) == codecs.BOM_UTF8 else self.ENCODING
+
+    @staticmethod
+    def __dialect(f):
+        # Exports use ',' or, with some locales, ';' or tabs
+        sample = f.read(64 * 1024)
+        f.seek(0)
+        try:
+            return csv.Sniffer().sniff(sample, delimiters=',;\t')
+        except csv.Error:
+            return csv.excel
+
+    def save_data(self):
+        try:
+            # The file is rewritten from its own text, so only the invoice cells change
+            with open(self.file_path, 'r', encoding=self.encoding, newline='') as f:
+                dialect = self.__dialect(f)
+                rows = list(csv.reader(f, dialect))
+            invoice_header = self.mapping.header('invoice')
+            if invoice_header not in rows[0]:
+                rows[0].append(invoice_header)
+            invoice_idx = rows[0].index(invoice_header)
+            for row_index in sorted(self.dirty_rows):
+                row = rows[row_index + 1]
+                row.extend([''] * (invoice_idx + 1 - len(row)))
+                row[invoice_idx] = 'TRUE'
+
+            # Swapped in, so a crash mid-save cannot corrupt the file
+            with replaced_atomically(self.file_path) as temp_path:
+                with open(temp_path, 'w', encoding=self.encoding, newline='') as f:
+                    csv.writer(f, dialect).writerows(rows)
+            return True
+        except Exception as e:
+            self.logger.error("An unexpected error occurred while saving: %s", e)
+            return False
@@ -0,0 +1,61 @@
+import threading
+
+from logger import Logger
+
+logger = Logger.get_logger(__name__)
+
+
+class DocumentIndex:
+    def __init__(self, documents=()):
+        # Issued documents keyed by (client name, document date, amount). A key can hold several documents,
+        # e.g. two equal payments of one client on the same day, and every row claims at most one of them.
+        self.documents = {}
+        self.lock = threading.Lock()
+        for document in documents:
+            self.add(document)
+
+    @classmethod
+    def reconcile(cls, journal, invoiced, dates=(), search_documents=None):
+        # One paged bulk query over the dates of the rows still to be issued, instead of trusting the Invoice
+        # column alone. The documents and journal entries of the invoiced (client, date, amount) rows are
+        # accounted for first, so only the remainder can match a row that looks new. Without search_documents
+        # only the journal is reconciled.
+        dates = [date for date in dates if date]
+        index = cls(search_documents(min(dates), max(dates)) if search_documents and dates else ())
+        for client_name, date, amount in invoiced:
+            journal.claim_invoiced(client_name, date, amount, index.claim(client_name, date, amount))
+        if search_documents:
+            logger.info("%s issued documents are not matched to an invoiced row", len(index))
+        return index
+
+    def claim_issued(self, journal, row_index, client_name, date, amount):
+        # Claims the document already issued for a row and journals the row as issued by it
+        document = self.claim(client_name, date, amount)
+        if document:
+            logger.warning("Row %s matches document %s already issued to %s on %s, not issuing it again",
+                           row_index, document.get('number'), client_name, date)
+            journal.claim_document(row_index, client_name, document)
+        return document
+
+    @staticmethod
+    def key(client_name, date, amount):
+        try:
+            amount = round(float(amount or 0), 2)
+        except (TypeError, ValueError):
+            pass
+        return client_name, date, amount
+
+    def add(self, document):
+        client_name = (document.get('client') or {}).get('name')
+        key = self.key(client_name, document.get('documentDate'), document.get('amount'))
+        with self.lock:
+            self.documents.setdefault(key, []).append(document)
+
+    def claim(self, client_name, date, amount):
+        with self.lock:
+            matches = self.documents.get(self.key(client_name, date, amount))
+            return matches.pop(0) if matches else None
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(matches) for matches in self.documents.values())
@@ -1,82 +1,92 @@
 from datetime import datetime
-from openpyxl import load_workbook
-from logger import Logger
+
+from SheetReader import SheetReader
+from paths import replaced_atomically
 
 current_date_time = datetime.now().strftime("%Y%m%d_%H%M%S")
 
 
-class ExcelParser:
-    def __init__(self, file_path):
-        self.logger = Logger.get_logger(__name__)
-        self.data = []
-        self.__load_data(file_path)
-        self.file_path = file_path
+class ExcelParser(SheetReader):
+    FLUSH_EVERY = SheetReader.FLUSH_EVERY
+    FLUSH_INTERVAL = SheetReader.FLUSH_INTERVAL
+
+    def __init__(self, file_path, flush_every=FLUSH_EVERY, flush_interval=FLUSH_INTERVAL, streaming=False,
+                 metrics=None, mapping=None):
+        # In streaming mode rows are read lazily from a read-only workbook by iter_rows
+        super().__init__(file_path, flush_every=flush_every, flush_interval=flush_interval, metrics=metrics,
+                         mapping=mapping, streaming=streaming)
 
-    def __load_data(self, file_path):
+    def load_data(self):
+        # openpyxl is the slowest import of the app, so it is only loaded once a workbook is opened
+        from openpyxl import load_workbook
         try:
-            workbook = load_workbook(filename=file_path)
-            sheet = workbook['EFT & Paybox']
+            workbook = load_workbook(filename=self.file_path, read_only=self.streaming)
+            sheet = workbook[self.mapping.sheet_name]
+
+            self.set_headers(cell.value for cell in next(sheet.iter_rows(max_row=1)))
 
-            headers = [cell.value for cell in sheet[1]]
+            if self.streaming:
+                workbook.close()
+                return
 
+            client_idx = self.index_of('client')
             for row in sheet.iter_rows(min_row=2, values_only=True):
                 # Stop reading when 'Client' is None
-                if row[0] is None:
+                if client_idx is None or client_idx >= len(row) or row[client_idx] is None:
                     break
 
-                row_data = {headers[col_idx]: cell for col_idx, cell in enumerate(row) if col_idx < len(headers)}
-                self.data.append(row_data)
+                self.data.append(list(row[:len(self.headers)]))
+            self.row_count = len(self.data)
         except FileNotFoundError:
-            self.logger.error(f"Error: File not found: {file_path}")
+            self.logger.error("Error: File not found: %s", self.file_path)
             exit(-1)
         except Exception as e:
-            self.logger.error(f"An unexpected error occurred: {e}")
+            self.logger.error("An unexpected error occurred: %s", e)
             exit(-1)
 
-    def get_row(self, row_index):
-        self.logger.debug(f"Getting row {row_index}")
-        try:
-            if 0 <= row_index < len(self.data):
-                return self.data[row_index]
-            else:
-                raise IndexError(f"Error: Index out of range: {row_index}")
-        except IndexError as e:
-            self.logger.error(e)
-            return None
-
-    def get_cell(self, row_data, column_name):
-        try:
-            if row_data and column_name in row_data:
-                cell_value = row_data[column_name]
-                # Check if the cell value is of type float (double) and cast it to int
-                if isinstance(cell_value, float):
-                    return int(cell_value)
-                return cell_value
-            else:
-                raise KeyError(f"Error: Column not found: {column_name}")
-        except KeyError as e:
-            self.logger.error(e)
-            return None
-
-    def change_invoice_status(self, row_index: int):
+    def iter_rows(self):
+        if not self.streaming:
+            yield from super().iter_rows()
+            return
+
+        from openpyxl import load_workbook
+        workbook = load_workbook(filename=self.file_path, read_only=True)
+        self.stream_open = True
         try:
-            if 0 <= row_index < len(self.data):
-                self.data[row_index]['Invoice'] = True
-                self.__save_data()
-                self.logger.debug(f"Changed invoice status of row {row_index} to True")
-            else:
-                raise IndexError(f"Error: Index out of range: {row_index}")
-        except IndexError as e:
-            self.logger.error(e)
-
-    def __save_data(self):
+            sheet = workbook[self.mapping.sheet_name]
+            client_idx = self.index_of('client')
+            invoice_idx = self.index_of('invoice')
+            for row_index, row in enumerate(sheet.iter_rows(min_row=2, values_only=True)):
+                # Stop reading when 'Client' is None
+                if not row or client_idx is None or client_idx >= len(row) or row[client_idx] is None:
+                    break
+
+                self.row_count = max(self.row_count, row_index + 1)
+                if invoice_idx is None or invoice_idx >= len(row) or not row[invoice_idx]:
+                    self.row_keys[row_index] = self.row_key(row)
+                if row_index in self.dirty_rows and invoice_idx is not None and invoice_idx < len(row):
+                    row = row[:invoice_idx] + (True,) + row[invoice_idx + 1:]
+                yield row_index, row
+        finally:
+            workbook.close()
+            self.stream_open = False
+            # Writes are held back while the read-only workbook is open, catch up now
+            self.flush()
+
+    def save_data(self):
+        from openpyxl import load_workbook
         try:
             workbook = load_workbook(filename=self.file_path)
-            sheet = workbook['EFT & Paybox']
+            sheet = workbook[self.mapping.sheet_name]
+            invoice_column = self.headers.index(self.mapping.header('invoice')) + 1
+
+            for row_index in sorted(self.dirty_rows):
+                sheet.cell(row=row_index + 2, column=invoice_column, value=True)
 
-            for idx, row_data in enumerate(self.data):
-                for col_idx, (key, value) in enumerate(row_data.items()):
-                    sheet.cell(row=idx + 2, column=col_idx + 1, value=value)
-            workbook.save(filename=self.file_path)
+            # Save next to the original and swap it in, so a crash mid-save cannot corrupt the workbook
+            with replaced_atomically(self.file_path) as temp_path:
+                workbook.save(filename=temp_path)
+            return True
         except Exception as e:
-            self.logger.error(f"An unexpected error occurred while saving: {e}")
+            self.logger.error("An unexpected error occurred while saving: %s", e)
+            return False
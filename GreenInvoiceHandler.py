@@ -1,62 +1,198 @@
-import base64
 import json
-from datetime import datetime
-from urllib.request import Request, urlopen
-from urllib.error import HTTPError
-from green_invoice.models import Currency, DocumentLanguage, DocumentType
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from http.client import HTTPException
+from urllib.error import HTTPError, URLError
 
+from ClientCache import ClientCache
+from ConnectionPool import ConnectionPool
+from Metrics import Metrics
+from PreviewWriter import PreviewWriter
+from RateLimiter import RateLimiter
+from TokenManager import TokenManager
 from logger import Logger
 
 
+class RequestError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
 class GreenInvoiceHandler:
     BASE_URL = 'https://api.greeninvoice.co.il/api/v1'
     INVOICE_DOC_NUMBER = 320
+    CLIENTS_PAGE_SIZE = 100
+    DOCUMENTS_PAGE_SIZE = 100
+    PREVIEW_DIRECTORY = 'Samples/Invoices'
+    MAX_RETRIES = 5
+    BACKOFF_BASE = 0.5  # seconds
+    BACKOFF_MAX = 30  # seconds
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
 
-    def __init__(self, key, secret):
+    def __init__(self, key, secret, transport=None, base_url=BASE_URL, pool_size=ConnectionPool.POOL_SIZE,
+                 rate_limiter=None, client_cache=None, token_manager=None, preview_directory=PREVIEW_DIRECTORY,
+                 metrics=None, preview_cache=None):
         self.JWT = None
         self.status = None
         self.key = key
         self.secret = secret
+        self.base_url = base_url
+        # Any object with a ConnectionPool-compatible request() can be plugged in as the transport
+        self.transport = transport or ConnectionPool(base_url, pool_size=pool_size)
+        # Unlimited until the API throttles, then adapts to the rate it tolerates
+        self.rate_limiter = rate_limiter or RateLimiter(adaptive=True)
+        self.client_cache = client_cache or ClientCache()
+        self.token_manager = token_manager or TokenManager()
+        self.token_lock = threading.Lock()
+        self.preview_directory = preview_directory
+        # Optional PreviewCache, previews of a payload that was rendered before are copied from it
+        self.preview_cache = preview_cache
+        self.metrics = metrics or Metrics()
         self.logger = Logger.get_logger(__name__)
 
-    def __send_POST_request(self, headers, end_point, values, request_type):
-        global response_body
+    def close(self):
+        self.transport.close()
+
+    def __send_POST_request(self, headers, end_point, values, request_type, stream=False, idempotent=False):
         data = json.dumps(values).encode('utf-8')  # Convert the dictionary to a JSON string and then encode it to bytes
         if request_type != "JWT":
-            self.logger.info(
-                f"Sending {request_type} request; URL: {self.BASE_URL}{end_point}, Values: {values}")
+            # Payloads are only serialized when DEBUG is enabled for this module
+            self.logger.debug("Sending %s request; URL: %s%s, Values: %s", request_type, self.base_url, end_point,
+                              values)
         try:
-            request = Request(self.BASE_URL + end_point, data=data, headers=headers)
-            response = urlopen(request)
-            response_body = response.read()
+            try:
+                response = self.__request(end_point, data, headers, request_type, stream, idempotent)
+            except HTTPError as err:
+                if err.code != 401 or 'Authorization' not in headers:
+                    raise
+                # The token expired or was revoked mid-run, refresh it and retry once
+                self.logger.warning("%s request was unauthorized, refreshing token and retrying", request_type)
+                self.token_manager.invalidate(headers['Authorization'][len('Bearer '):])
+                headers = dict(headers, Authorization='Bearer ' + self.__valid_token())
+                response = self.__request(end_point, data, headers, request_type, stream, idempotent)
+            if stream:
+                # The caller reads and closes the body itself
+                return response.body
+            response_body = response.body
             status = response.status
             if status == 200:
                 if request_type != "JWT":
-                    if request_type != "preview":
-                        self.logger.info(f"Response body: {response_body}")
-                    else:
-                        self.logger.info(response_body)
+                    self.logger.debug("Response body: %s", response_body)
         except HTTPError as err:
             self.logger.error(err)
-            self.logger.error(response_body)
-            exit(-1)
-        return json.loads(response_body)  # Parse the JSON response and return
+            self.logger.error(err.read())
+            raise RequestError(f"{request_type} request failed: {err}", err.code) from err
+        except (URLError, OSError, HTTPException) as err:
+            # No answer was read, so the request may or may not have been processed
+            self.logger.error(err)
+            raise RequestError(f"{request_type} request failed: {err}") from err
+        try:
+            return json.loads(response_body)  # Parse the JSON response and return
+        except ValueError as err:
+            self.logger.error("%s response is not JSON: %s", request_type, err)
+            raise RequestError(f"{request_type} response is not JSON: {err}") from err
 
-    def generate_token(self):
-        end_point = '/account/token'
-        values = {
-            'id': self.key,
-            'secret': self.secret
-        }
+    def __request(self, end_point, data, headers, request_type, stream=False, idempotent=False):
+        # A throttled request was refused before being processed, so any call can be retried after a 429.
+        # Server errors and dropped connections are only retried for calls that are safe to repeat.
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            self.metrics.count('requests')
+            try:
+                # Only a call that is safe to repeat is sent again when its connection drops mid-request
+                if stream:
+                    response = self.transport.request('POST', end_point, data, headers, stream=True,
+                                                      idempotent=idempotent)
+                else:
+                    response = self.transport.request('POST', end_point, data, headers, idempotent=idempotent)
+            except HTTPError as err:
+                retry_after = self.__retry_after(err)
+                if err.code == 429:
+                    self.rate_limiter.throttled(retry_after)
+                    self.metrics.count('throttled')
+                if attempt >= self.MAX_RETRIES or not (err.code == 429 or
+                                                       idempotent and err.code in self.RETRY_STATUSES):
+                    raise
+                reason = f"HTTP {err.code}"
+            except (URLError, OSError, HTTPException) as err:
+                # A malformed or truncated response is handled like a dropped connection
+                if attempt >= self.MAX_RETRIES or not idempotent:
+                    raise
+                retry_after = None
+                reason = str(err)
+            else:
+                self.rate_limiter.succeeded()
+                return response
 
-        headers = {
-            'Content-Type': 'application/json'
-        }
-        parsed_response = self.__send_POST_request(headers, end_point, values, "JWT")
+            # Full jitter keeps concurrent workers from retrying in lockstep
+            delay = retry_after if retry_after is not None else \
+                random.uniform(0, min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** attempt))
+            attempt += 1
+            self.metrics.count('retries')
+            self.logger.warning("%s request failed (%s), retry %s of %s in %.2fs", request_type, reason, attempt,
+                                self.MAX_RETRIES, delay)
+            time.sleep(delay)
 
-        self.JWT = parsed_response['token']
+    @staticmethod
+    def __retry_after(err):
+        value = err.headers.get('Retry-After') if err.headers else None
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            # An HTTP date instead of a number of seconds
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+    def generate_token(self, force=False):
+        with self.token_lock:
+            token = None if force else self.token_manager.valid_token()
+            if token:
+                self.logger.debug("Reusing stored token")
+                self.JWT = token
+                return
+
+            end_point = '/account/token'
+            values = {
+                'id': self.key,
+                'secret': self.secret
+            }
+
+            headers = {
+                'Content-Type': 'application/json'
+            }
+            with self.metrics.time('token'):
+                parsed_response = self.__send_POST_request(headers, end_point, values, "JWT", idempotent=True)
+
+            self.JWT = parsed_response['token']
+            self.token_manager.store(self.JWT, parsed_response.get('expires'))
+
+    def __valid_token(self):
+        token = self.token_manager.valid_token()
+        if token is None:
+            # Missing, rejected or about to expire
+            self.generate_token()
+            token = self.JWT
+        return token
 
     def search_client_by_name(self, name):
+        cached = self.client_cache.get(name)
+        if cached:
+            self.logger.debug("client %s resolved from cache", name)
+            self.metrics.count('client_cache_hits')
+            return cached
+        self.metrics.count('client_cache_misses')
+
         end_point = '/clients/search'
         values = {
             'name': name,
@@ -67,35 +203,74 @@ class GreenInvoiceHandler:
 
         headers = {
             'Content-Type': 'application/json',
-            'Authorization': 'Bearer ' + self.JWT
+            'Authorization': 'Bearer ' + self.__valid_token()
         }
         try:
-            parsed_response = self.__send_POST_request(headers, end_point, values, "client search")
+            with self.metrics.time('client_search'):
+                parsed_response = self.__send_POST_request(headers, end_point, values, "client search",
+                                                           idempotent=True)
             total_value = parsed_response['total']
             if total_value == 0:
                 return None
 
             elif total_value == 1:
-                self.logger.debug(f"client {name}, found total {total_value} client")
+                self.logger.debug("client %s, found total %s client", name, total_value)
                 first_item = parsed_response['items'][0]
                 id_value = first_item['id']
-                self.logger.debug(f"Parsed id of {name} is: {id_value}")
+                self.logger.debug("Parsed id of %s is: %s", name, id_value)
 
-                # Check if emails exist and extract the first one
-                emails = first_item.get('emails', [])
-                first_email = emails[0] if emails else None
+                first_email = self.__first_email(first_item)
                 if first_email:
-                    self.logger.debug(f"Parsed email of {name} is: {first_email}")
-                    return id_value, first_email
-                else:
-                    return id_value, None
+                    self.logger.debug("Parsed email of %s is: %s", name, first_email)
+                self.client_cache.put(name, id_value, first_email)
+                return id_value, first_email
             else:
-                self.logger.warning(f"Found {total_value} clients under the name {name}")
+                self.logger.warning("Found %s clients under the name %s", total_value, name)
                 return None
         except RuntimeError as err:
-            self.logger.error(f"Error in finding client: {err}")
+            self.logger.error("Error in finding client: %s", err)
             return None
 
+    def prefetch_clients(self):
+        end_point = '/clients/search'
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': 'Bearer ' + self.__valid_token()
+        }
+        clients = {}
+        duplicates = set()
+        page = 1
+        while True:
+            values = {
+                'active': 'true',
+                'page': page,
+                'pageSize': self.CLIENTS_PAGE_SIZE
+            }
+            with self.metrics.time('client_prefetch'):
+                parsed_response = self.__send_POST_request(headers, end_point, values, "client prefetch",
+                                                           idempotent=True)
+            items = parsed_response.get('items', [])
+            for item in items:
+                name = item.get('name')
+                if name in clients:
+                    duplicates.add(name)
+                clients[name] = (item['id'], self.__first_email(item))
+            if not items or page >= parsed_response.get('pages', page):
+                break
+            page += 1
+
+        # Ambiguous names are left to search_client_by_name, which reports them
+        for name in duplicates:
+            del clients[name]
+        self.client_cache.replace_all(clients)
+        self.logger.info("Prefetched %s clients (%s ambiguous names skipped)", len(clients), len(duplicates))
+
+    @staticmethod
+    def __first_email(item):
+        # Check if emails exist and extract the first one
+        emails = item.get('emails') or []
+        return emails[0] if emails else None
+
     def add_client(self, client_name):
         end_point = '/clients'
         values = {
@@ -103,25 +278,95 @@ class GreenInvoiceHandler:
         }
         headers = {
             'Content-Type': 'application/json',
-            'Authorization': 'Bearer ' + self.JWT
+            'Authorization': 'Bearer ' + self.__valid_token()
         }
-        self.__send_POST_request(headers, end_point, values, "add client")
+        with self.metrics.time('client_create'):
+            parsed_response = self.__send_POST_request(headers, end_point, values, "add client")
+        if 'id' not in parsed_response:
+            return None
+        # Later searches for the new client are answered from the cache
+        self.client_cache.put(client_name, parsed_response['id'], self.__first_email(parsed_response))
+        return parsed_response['id']
 
-    def generate_new_invoice_preview(self, parsed_values, client_name):
+    def search_documents(self, from_date, to_date):
+        end_point = '/documents/search'
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': 'Bearer ' + self.__valid_token()
+        }
+        documents = []
+        page = 1
+        while True:
+            values = {
+                'fromDate': from_date,
+                'toDate': to_date,
+                'type': [self.INVOICE_DOC_NUMBER],
+                'page': page,
+                'pageSize': self.DOCUMENTS_PAGE_SIZE
+            }
+            with self.metrics.time('document_search'):
+                parsed_response = self.__send_POST_request(headers, end_point, values, "document search",
+                                                           idempotent=True)
+            items = parsed_response.get('items', [])
+            documents.extend(items)
+            if not items or page >= parsed_response.get('pages', page):
+                break
+            page += 1
+        self.logger.info("Found %s documents issued between %s and %s", len(documents), from_date, to_date)
+        return documents
+
+    def preview_path(self, client_name, row_index=None):
+        time_stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        if row_index is None:
+            return os.path.join(self.preview_directory, f"{client_name}_{time_stamp}_Invoice.pdf")
+        # Concurrent previews of the same client can finish within the same second
+        return os.path.join(self.preview_directory, f"{client_name}_{time_stamp}_{row_index}_Invoice.pdf")
+
+    def generate_new_invoice_preview(self, parsed_values, client_name, output_filepath=None):
         print(f"Generating preview for {client_name}")
         end_point = '/documents/preview'
         values = parsed_values
 
+        if output_filepath is None:
+            output_filepath = self.preview_path(client_name)
+        payload_hash = None
+        if self.preview_cache is not None:
+            payload_hash = self.preview_cache.key(values)
+            if self.preview_cache.get(payload_hash, output_filepath):
+                self.metrics.count('preview_cache_hits')
+                self.logger.info("The preview PDF of an unchanged payload was copied from the cache to %s",
+                                 output_filepath)
+                return output_filepath
+            self.metrics.count('preview_cache_misses')
+
         headers = {
             'Content-Type': 'application/json',
-            'Authorization': 'Bearer ' + self.JWT
+            'Authorization': 'Bearer ' + self.__valid_token()
         }
-        response_body = self.__send_POST_request(headers, end_point, values, "preview")
-        if 'file' in response_body:
-            time_stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            self.__base64_to_pdf(response_body['file'], f"Samples/Invoices/{client_name}_{time_stamp}_Invoice.pdf")
-        else:
+        # The base64 PDF is decoded straight to disk as it arrives instead of being held in memory or logged
+        with self.metrics.time('preview_download'):
+            try:
+                response_body = self.__send_POST_request(headers, end_point, values, "preview", stream=True,
+                                                         idempotent=True)
+            except RequestError as e:
+                self.__forget_rejected_client(client_name, e)
+                raise
+        with response_body:
+            try:
+                with self.metrics.time('pdf_write'):
+                    size, metadata = PreviewWriter(response_body).write(output_filepath)
+            except (ValueError, OSError, HTTPException) as e:
+                self.logger.error("An error occurred: %s", e)
+                raise RequestError(f"preview could not be saved: {e}") from e
+
+        if size is None:
             self.logger.error("'file' key does not exist in the response body.")
+            raise RequestError(f"preview response has no file: {metadata}")
+        self.logger.info("The preview PDF has been successfully saved at %s (%s bytes), response: %s",
+                         output_filepath, size, metadata)
+        if payload_hash is not None:
+            self.preview_cache.put(payload_hash, output_filepath)
+        return output_filepath
 
     def generate_new_invoice(self, parsed_values, client_name):
         print(f"Generating invoice for {client_name}")
@@ -130,11 +375,25 @@ class GreenInvoiceHandler:
 
         headers = {
             'Content-Type': 'application/json',
-            'Authorization': 'Bearer ' + self.JWT
+            'Authorization': 'Bearer ' + self.__valid_token()
         }
-        self.__send_POST_request(headers, end_point, values, "generate")
+        with self.metrics.time('document_generate'):
+            try:
+                return self.__send_POST_request(headers, end_point, values, "generate")
+            except RequestError as e:
+                self.__forget_rejected_client(client_name, e)
+                raise
+
+    def __forget_rejected_client(self, client_name, error):
+        # A refused document may name a client id that was deleted or merged since it was cached, so the client
+        # is looked up again next time instead of being refused until the cache entry expires
+        if error.status is not None and 400 <= error.status < 500 and error.status not in (401, 429):
+            self.logger.info("Dropping the cached id of client %s after the request was refused", client_name)
+            self.client_cache.invalidate(client_name)
 
     def parse_values(self, id_value, payment_details, payment_date, income_list, client_email=None):
+        # The green_invoice package pulls in requests, so it is only imported once a document is built
+        from green_invoice.models import Currency, DocumentLanguage, DocumentType
 
         values = {
 
@@ -159,17 +418,6 @@ class GreenInvoiceHandler:
         if client_email:
             values['client']['emails'] = [client_email]
 
-        self.logger.debug(f"Values: {values}")
+        self.logger.debug("Values: %s", values)
 
         return values
-
-    def __base64_to_pdf(self, base64_data, output_filepath):
-        try:
-            decoded_data = base64.b64decode(base64_data)
-
-            with open(output_filepath, 'wb') as file:
-                file.write(decoded_data)
-
-            self.logger.info(f"The preview PDF has been successfully saved at {output_filepath}")
-        except Exception as e:
-            self.logger.error(f"An error occurred: {e}")
@@ -1,11 +1,15 @@
+import queue
 import threading
+import time
 import tkinter as tk
+from datetime import timedelta
 from tkinter import filedialog, messagebox, ttk
-from invoiceApp import InvoiceApp
 from logger import Logger
 
 
 class InvoiceAppGUI:
+    POLL_INTERVAL = 100  # milliseconds
+
     def __init__(self, root):
         self.logger = Logger.get_logger(__name__)
         self.root = root
@@ -22,53 +26,190 @@ class InvoiceAppGUI:
         for mode in modes:
             tk.Radiobutton(root, text=mode, variable=self.mode, value=mode).pack()
 
-        tk.Button(root, text="Run", command=self.run_mode).pack()
-
-        self.progress_bar = ttk.Progressbar(root, orient="horizontal", length=300, mode="indeterminate")
-        self.progress_bar.pack(pady=20)
+        buttons = tk.Frame(root)
+        buttons.pack()
+        self.run_button = tk.Button(buttons, text="Run", command=self.run_mode)
+        self.run_button.pack(side=tk.LEFT)
+        self.cancel_button = tk.Button(buttons, text="Cancel", command=self.cancel, state=tk.DISABLED)
+        self.cancel_button.pack(side=tk.LEFT)
+
+        self.progress_bar = ttk.Progressbar(root, orient="horizontal", length=300, mode="determinate")
+        self.progress_bar.pack(pady=(20, 0))
+        self.status = tk.StringVar()
+        tk.Label(root, textvariable=self.status).pack()
+        tk.Label(root, text="Failed rows:").pack()
+        self.failures = tk.Listbox(root, width=70, height=6)
+        self.failures.pack()
+
+        # Widgets are only touched on the Tk thread: worker threads put progress events, and callables to run
+        # on the Tk thread, on this queue, which poll_events drains
+        self.events = queue.Queue()
+        self.run_started = None
 
         self.invoice_app = None
+        # Set by Cancel and shared with every app, so a cancel before the run has started is not lost
+        self.cancel_requested = threading.Event()
+        # Owned by the window and shared by every run: credentials, token, connection pool, client lookups and
+        # the parsed workbook (until it changes on disk) are only loaded once
+        self.session = None
+        self.prepare_lock = threading.Lock()
+        root.protocol("WM_DELETE_WINDOW", self.close)
 
         self.logger.debug("InvoiceAppGUI initialized")
+        # The window is shown before the app modules are imported and the token is fetched
+        threading.Thread(target=self.prepare, args=(self.mode.get(), None), daemon=True).start()
+        self.root.after(self.POLL_INTERVAL, self.poll_events)
+
+    def prepare(self, mode, file):
+        from GreenInvoiceHandler import RequestError
+
+        with self.prepare_lock:
+            app = self.new_app(mode, file)
+            try:
+                app.warm_up()
+            except RequestError as e:
+                # Reported again by the run itself
+                self.logger.warning("Could not warm up: %s", e)
+
+    def new_app(self, mode, file):
+        # Called with prepare_lock held
+        from invoiceApp import InvoiceApp
+        from Session import Session
+        if self.session is None:
+            self.session = Session(pool_size=InvoiceApp.CLIENT_WORKERS, keep_files=True)
+        return InvoiceApp(mode, file, session=self.session, progress=self.events, cancelled=self.cancel_requested)
 
     def browse_file(self):
         file = filedialog.askopenfilename()
-        self.logger.debug(f"Selected file: {file}")
+        self.logger.debug("Selected file: %s", file)
         if file:
             self.filename.set(file)
+            threading.Thread(target=self.prepare, args=(self.mode.get(), file), daemon=True).start()
 
     def run_mode(self):
         file = self.filename.get()
         mode = self.mode.get()
-        self.logger.debug(f"Run mode started with file: {file}, mode: {mode}")
+        self.logger.debug("Run mode started with file: %s, mode: %s", file, mode)
         if not file or not mode:
             messagebox.showerror("Error", "Please select a file and a mode")
             return
+        self.run_button.config(state=tk.DISABLED)
+        self.cancel_button.config(state=tk.NORMAL)
+        self.failures.delete(0, tk.END)
+        self.progress_bar.config(value=0)
+        self.status.set("Reading the file...")
+        self.cancel_requested.clear()
         threading.Thread(target=self.start_task, args=(mode, file), daemon=True).start()
 
+    def cancel(self):
+        self.cancel_requested.set()
+        self.cancel_button.config(state=tk.DISABLED)
+        self.status.set("Cancelling, waiting for the requests already sent...")
+
     def start_task(self, mode, file):
-        self.logger.debug(f"Starting task with mode: {mode}, file: {file}")
-        self.progress_bar.start()
-        self.invoice_app = InvoiceApp(mode, file)
-        result = self.invoice_app.run()
-        self.logger.debug(f"Task completed with result: {result}")
-        self.root.after(0, self.handle_result, mode, result)
-        self.progress_bar.stop()
+        self.logger.debug("Starting task with mode: %s, file: %s", mode, file)
+        try:
+            # Waits for a warm-up still in progress rather than loading the same workbook twice
+            with self.prepare_lock:
+                app = self.new_app(mode, file)
+            self.invoice_app = app
+            if self.cancel_requested.is_set():
+                result = f"{mode} cancelled before it started"
+            else:
+                result = app.run()
+        except SystemExit:
+            # Missing or unreadable credentials, an unreadable file or an invoice issued out of order
+            result = f"{mode} stopped, see the log for details"
+        except Exception as e:
+            self.logger.error("%s failed: %s", mode, e)
+            result = f"{mode} failed: {e}"
+        self.logger.debug("Task completed with result: %s", result)
+        self.events.put(lambda: self.handle_result(mode, result))
+
+    def poll_events(self):
+        try:
+            while True:
+                event = self.events.get_nowait()
+                if callable(event):
+                    event()
+                elif hasattr(event, 'phase'):
+                    self.show_row_progress(event)
+                else:
+                    self.show_client_progress(event)
+        except queue.Empty:
+            pass
+        finally:
+            self.root.after(self.POLL_INTERVAL, self.poll_events)
+
+    def show_row_progress(self, event):
+        if event.phase == 'started':
+            self.run_started = time.perf_counter()
+            self.progress_bar.config(maximum=max(1, event.total), value=0)
+        else:
+            self.progress_bar.config(value=event.done)
+            if not event.ok:
+                self.failures.insert(tk.END, f"Row {event.row_index} ({event.client_name}): {event.error}")
+                self.failures.see(tk.END)
+        elapsed = time.perf_counter() - self.run_started if self.run_started else 0
+        rate = event.done / elapsed if elapsed > 0 else 0
+        status = f"{event.done} of {event.total} rows, {rate:.1f} rows/s"
+        if rate > 0 and event.done < event.total:
+            status += f", about {timedelta(seconds=round((event.total - event.done) / rate))} left"
+        self.status.set(status)
 
     def handle_result(self, mode, result):
-        self.logger.debug(f"Handling result with mode: {mode}, result: {result}")
-        if mode == 'checkClient':
+        self.logger.debug("Handling result with mode: %s, result: %s", mode, result)
+        self.run_button.config(state=tk.NORMAL)
+        self.cancel_button.config(state=tk.DISABLED)
+        self.run_started = None
+        if mode == 'checkClient' and not isinstance(result, str):
             if result:
                 missing_clients_str = "\n".join(result)
                 if messagebox.askyesno("Missing Clients",
                                        f"These clients are missing:\n{missing_clients_str}\nDo you want to add them?"):
-                    for missing_client in result:
-                        self.invoice_app.handle_missing_clients(missing_client)
+                    self.add_clients(result)
         else:
             messagebox.showinfo("Result", result)
 
+    def add_clients(self, client_names):
+        # The requests run on a background pool; the window only ever reads the events queue
+        self.run_button.config(state=tk.DISABLED)
+        self.progress_bar.config(maximum=len(client_names), value=0)
+        self.status.set(f"Adding {len(client_names)} clients...")
+        threading.Thread(target=self.add_clients_task, args=(self.invoice_app, client_names), daemon=True).start()
+
+    def add_clients_task(self, app, client_names):
+        try:
+            created, failed = app.add_clients(client_names, progress=self.events)
+        except Exception as e:
+            self.logger.error("Adding clients failed: %s", e)
+            created, failed = {}, {name: str(e) for name in client_names}
+        self.events.put(lambda: self.show_clients_added(created, failed))
+
+    def show_client_progress(self, event):
+        self.progress_bar.config(value=event.done)
+        self.status.set(f"Added {event.done} of {event.total} clients: {event.name}"
+                        + (f" failed ({event.error})" if event.error else ""))
+        if event.error:
+            self.failures.insert(tk.END, f"{event.name}: {event.error}")
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+        self.root.destroy()
+
+    def show_clients_added(self, created, failed):
+        self.run_button.config(state=tk.NORMAL)
+        self.status.set("")
+        message = f"{len(created)} clients added"
+        if failed:
+            failed_str = "\n".join(f"{name}: {error}" for name, error in sorted(failed.items()))
+            messagebox.showerror("Missing Clients", f"{message}, these could not be added:\n{failed_str}")
+        else:
+            messagebox.showinfo("Missing Clients", message)
+
 
-def center_window(root, width=600, height=400):
+def center_window(root, width=600, height=560):
     screen_width = root.winfo_screenwidth()
     # Get screen width and height
     screen_height = root.winfo_screenheight()
@@ -81,7 +222,12 @@ def center_window(root, width=600, height=400):
     root.geometry(f'{width}x{height}+{x}+{y}')
 
 
-root = tk.Tk()
-center_window(root)  # Centers the window with 600x400 size
-app = InvoiceAppGUI(root)
-root.mainloop()
+def main():
+    root = tk.Tk()
+    center_window(root)  # Centers the window with 600x560 size
+    InvoiceAppGUI(root)
+    root.mainloop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+from paths import replaced_atomically
+
+
+class Metrics:
+    PREFIX = 'greeninvoice'
+
+    def __init__(self):
+        # Timers keep count, total and slowest seconds per phase; counters are plain totals
+        self.timers = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def time(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - start)
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            count, total, slowest = self.timers.get(phase, (0, 0.0, 0.0))
+            self.timers[phase] = (count + 1, total + seconds, max(slowest, seconds))
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self):
+        with self.lock:
+            self.timers.clear()
+            self.counters.clear()
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'phases': {phase: {'count': count, 'seconds': total, 'max_seconds': slowest,
+                                   'mean_seconds': total / count if count else 0.0}
+                           for phase, (count, total, slowest) in self.timers.items()},
+                'counters': dict(self.counters),
+            }
+
+    def summary(self):
+        snapshot = self.to_dict()
+        header = f"{'phase':<20} {'count':>7} {'total s':>9} {'mean ms':>9} {'max ms':>9}"
+        lines = [header, '-' * len(header)]
+        for phase, timer in sorted(snapshot['phases'].items(), key=lambda item: -item[1]['seconds']):
+            lines.append(f"{phase:<20} {timer['count']:>7} {timer['seconds']:>9.3f} "
+                         f"{timer['mean_seconds'] * 1000:>9.2f} {timer['max_seconds'] * 1000:>9.2f}")
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f"{name:<20} {value:>7}")
+        return "\n".join(lines)
+
+    def write(self, output_path):
+        # .prom files follow the node_exporter textfile format, anything else is written as JSON
+        if output_path.endswith('.prom'):
+            content = self.__prometheus()
+        else:
+            content = json.dumps(self.to_dict(), indent=2)
+        # Replaced in one step, so a collector never reads a half written file
+        with replaced_atomically(output_path) as temp_path:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+
+    def __prometheus(self):
+        snapshot = self.to_dict()
+        lines = [f"# TYPE {self.PREFIX}_phase_seconds_total counter",
+                 f"# TYPE {self.PREFIX}_phase_count_total counter",
+                 f"# TYPE {self.PREFIX}_phase_max_seconds gauge"]
+        for phase, timer in sorted(snapshot['phases'].items()):
+            lines.append(f'{self.PREFIX}_phase_seconds_total{{phase="{phase}"}} {timer["seconds"]:.6f}')
+            lines.append(f'{self.PREFIX}_phase_count_total{{phase="{phase}"}} {timer["count"]}')
+            lines.append(f'{self.PREFIX}_phase_max_seconds{{phase="{phase}"}} {timer["max_seconds"]:.6f}')
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f"# TYPE {self.PREFIX}_{name}_total counter")
+            lines.append(f"{self.PREFIX}_{name}_total {value}")
+        return "\n".join(lines) + "\n"
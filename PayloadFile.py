@@ -0,0 +1,55 @@
+import json
+
+from logger import Logger
+from paths import replaced_atomically
+
+
+class PayloadFile:
+    def __init__(self, path):
+        # One JSON object per line: {"row": ..., "client": ..., "values": <parse_values payload>}, so a file of any
+        # size is written and replayed one document at a time. The first line names the workbook the payloads
+        # come from, and invoiced rows are kept as {"row", "client", "date", "amount", "invoiced": true}, so a
+        # replay can account for their documents the way generate does.
+        self.logger = Logger.get_logger(__name__)
+        self.path = path
+
+    def write(self, entries, source=None):
+        count = 0
+        # Swapped in once complete, a failed export never leaves half a file to be replayed
+        with replaced_atomically(self.path) as temp_path:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                if source is not None:
+                    f.write(json.dumps({'source': source}, ensure_ascii=False) + '\n')
+                for entry in entries:
+                    f.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':'), default=str) + '\n')
+                    if 'values' in entry:
+                        count += 1
+        return count
+
+    def source(self):
+        # The workbook the payloads were exported from, None for a file written without one
+        with open(self.path, 'r', encoding='utf-8') as f:
+            line = f.readline()
+        try:
+            header = json.loads(line)
+        except ValueError:
+            return None
+        return header.get('source') if isinstance(header, dict) and 'values' not in header else None
+
+    def __iter__(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError as e:
+                    self.logger.error("Skipping unreadable line %s of %s: %s", line_number, self.path, e)
+                    continue
+                if line_number == 1 and isinstance(entry, dict) and 'source' in entry:
+                    continue
+                if not isinstance(entry, dict) or not (isinstance(entry.get('values'), dict) or
+                                                       entry.get('invoiced')):
+                    self.logger.error("Skipping line %s of %s, it has no payload", line_number, self.path)
+                    continue
+                yield entry
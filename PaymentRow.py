@@ -0,0 +1,159 @@
+from collections import namedtuple
+from datetime import datetime
+
+from logger import Logger
+
+logger = Logger.get_logger(__name__)
+
+
+class RowError(Exception):
+    pass
+
+
+class PaymentRow(namedtuple('PaymentRow', ['row_index', 'client_name', 'invoice', 'date_paid', 'amount',
+                                           'number_of_treatments', 'treatments', 'payment_type', 'app_type',
+                                           'bank_details', 'error'])):
+    # One immutable record per sheet row, decoded once while the file is compiled. The documents are built from
+    # it by pure methods, so rows can be processed on any thread in any order.
+    __slots__ = ()
+
+    FIELDS = ('client', 'invoice', 'date_paid', 'amount_paid', 'number_of_apts', 'treatment', 'bank',
+              'bank_branch', 'account', 'bit', 'paybox', 'eft', 'cash')
+    # Payment columns in the order they are checked, with the app type each one stands for
+    PAYMENT_APPS = (('bit', 1), ('paybox', 3))
+
+    @classmethod
+    def columns(cls, reader):
+        # Column indexes are resolved once per file instead of once per cell
+        columns = {field: reader.index_of(field) for field in cls.FIELDS}
+        for field, col_idx in columns.items():
+            if col_idx is None:
+                logger.error("Error: Column not found: %s", reader.mapping.header(field))
+        return columns
+
+    @classmethod
+    def parse(cls, row_index, row_data, columns):
+        cells = {field: cls.__cell(row_data, col_idx) for field, col_idx in columns.items()}
+        try:
+            treatments = cls.__decode_treatments(cells['treatment'])
+            payment_type, app_type = cls.__decode_payment_method(cells)
+            error = None
+        except RowError as e:
+            treatments, payment_type, app_type, error = (), None, None, str(e)
+        except Exception as e:
+            treatments, payment_type, app_type, error = (), None, None, f"Error in parsing data: {e}"
+        return cls(row_index, cells['client'], cells['invoice'], cls.__decode_date_paid(cells['date_paid']),
+                   cells['amount_paid'], cells['number_of_apts'], treatments, payment_type, app_type,
+                   (cells['bank'], cells['bank_branch'], cells['account']), error)
+
+    def document(self):
+        return self.income_list(), self.payment_details()
+
+    def income_list(self):
+        from green_invoice.models import Currency
+        if self.error:
+            raise RowError(self.error)
+        if not isinstance(self.amount, (int, float)) or self.amount <= 0:
+            raise RowError(f"Amount Paid is not a positive number: {self.amount!r}")
+        if not isinstance(self.number_of_treatments, int) or self.number_of_treatments < 1:
+            raise RowError(f"Number of Apts is not a positive number: {self.number_of_treatments!r}")
+        if self.number_of_treatments > len(self.treatments):
+            raise RowError(f"Number of Apts ({self.number_of_treatments}) is larger than the number of dates "
+                           f"in Treatment ({len(self.treatments)})")
+
+        income_list = []
+        for i in range(self.number_of_treatments):
+            description = f"Physiotherapy - {self.treatments[i]}"
+            income_list.append(
+                {
+                    "catalogNum": "Physiotherapy session",
+                    'description': description,
+                    'quantity': 1,
+                    'price': self.amount / self.number_of_treatments,
+                    'currency': Currency.ILS,
+                    'vatType': 1,
+                }
+            )
+        return income_list
+
+    def payment_details(self):
+        from green_invoice.models import Currency, PaymentType
+        if self.error:
+            raise RowError(self.error)
+        if not self.date_paid:
+            raise RowError("Date Paid is missing")
+
+        payment_details = {
+            'date': self.date_paid,
+            'type': self.payment_type,
+            'price': self.amount,
+            'currency': Currency.ILS,
+            'dueDate': self.date_paid,
+        }
+
+        if self.payment_type == PaymentType.PAYMENT_APP:
+            payment_details.update({
+                'appType': self.app_type
+            })
+        elif self.payment_type == PaymentType.ELECTRONIC_FUND_TRANSFER:
+            payment_details.update({
+                'bankName': str(self.bank_details[0]),
+                'bankBranch': str(self.bank_details[1]),
+                'bankAccount': str(self.bank_details[2]),
+            })
+        elif self.payment_type == PaymentType.CASH:  # Cash
+            pass
+
+        else:
+            raise RowError(f"Unknown payment method: {self.payment_type}")
+        return [payment_details]
+
+    @staticmethod
+    def __cell(row_data, col_idx):
+        if col_idx is None or col_idx >= len(row_data):
+            return None
+        cell_value = row_data[col_idx]
+        # Check if the cell value is of type float (double) and cast it to int
+        if isinstance(cell_value, float):
+            return int(cell_value)
+        return cell_value
+
+    @staticmethod
+    def __decode_date_paid(date_paid):
+        try:
+            if date_paid:
+                return date_paid.strftime("%Y-%m-%d")
+            else:
+                return None
+        except AttributeError as e:
+            logger.error("Could not convert date_paid: %s", e)
+            return None
+
+    @staticmethod
+    def __decode_treatments(treatments_date):
+        if isinstance(treatments_date, datetime):
+            treatments_date = treatments_date.strftime('%m/%d/%Y')
+
+        if not isinstance(treatments_date, str):
+            raise RowError("treatments_date is not a string")
+
+        try:
+            # Split the dates and format them
+            dates = treatments_date.split(',')
+            formatted_dates = tuple(datetime.strptime(date.strip(), '%m/%d/%Y').strftime('%Y-%m-%d')
+                                    for date in dates)
+        except Exception as e:
+            raise RowError(f"An error occurred while converting treatment dates: {e}") from e
+        return formatted_dates
+
+    @classmethod
+    def __decode_payment_method(cls, cells):
+        from green_invoice.models import PaymentType
+        for field, app_type in cls.PAYMENT_APPS:
+            if cells[field]:
+                return PaymentType.PAYMENT_APP, app_type
+        if cells['eft']:
+            return PaymentType.ELECTRONIC_FUND_TRANSFER, None
+        if cells['cash']:
+            return PaymentType.CASH, None
+        raise RowError("No payment method found")
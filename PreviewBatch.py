@@ -0,0 +1,113 @@
+import csv
+import io
+import os
+import queue
+import re
+import shutil
+import tempfile
+import threading
+import zipfile
+
+from logger import Logger
+from paths import replaced_atomically
+
+
+class PreviewBatch:
+    QUEUE_SIZE = 64
+
+    def __init__(self, output_path):
+        # Collects preview PDFs into one .zip archive (with an index.csv) or one merged .pdf (with a bookmark
+        # per row). Files are appended on a background thread so disk I/O overlaps the next API call.
+        self.logger = Logger.get_logger(__name__)
+        self.output_path = output_path
+        self.merge_pdf = output_path.lower().endswith('.pdf')
+        if self.merge_pdf:
+            try:
+                from pypdf import PdfWriter
+            except ImportError:
+                raise RuntimeError("Writing previews into a merged PDF requires the 'pypdf' package") from None
+            self.pdf_writer = PdfWriter()
+        else:
+            self.pdf_writer = None
+
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        # Individual previews land here first and are removed once they are in the batch
+        self.staging_directory = tempfile.mkdtemp(prefix='previews_')
+        self.index = []
+        self.error = None
+        self.queue = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self.thread = threading.Thread(target=self.__write_previews, name='PreviewBatch', daemon=True)
+        self.thread.start()
+
+    def staging_path(self, row_index):
+        return os.path.join(self.staging_directory, f"{row_index}.pdf")
+
+    def add(self, pdf_path, row_index, client_name, amount):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((pdf_path, row_index, client_name, amount))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        shutil.rmtree(self.staging_directory, ignore_errors=True)
+        if self.error is not None:
+            raise self.error
+        self.logger.info("Wrote %s previews to %s", len(self.index), self.output_path)
+
+    def __write_previews(self):
+        archive = None
+        try:
+            if not self.merge_pdf:
+                archive = zipfile.ZipFile(self.output_path, 'w', compression=zipfile.ZIP_DEFLATED)
+        except OSError as e:
+            self.__fail(e)
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                # Keep draining so producers never block on a full queue
+                os.remove(item[0])
+                continue
+            try:
+                self.__append(archive, *item)
+            except Exception as e:
+                self.__fail(e)
+
+        try:
+            if self.error is None:
+                self.__finish(archive)
+            if archive is not None:
+                archive.close()
+        except Exception as e:
+            self.__fail(e)
+
+    def __fail(self, error):
+        self.logger.error("Could not write preview batch %s: %s", self.output_path, error)
+        self.error = error
+
+    def __append(self, archive, pdf_path, row_index, client_name, amount):
+        safe_name = re.sub(r'[^\w\-. ]', '_', str(client_name))
+        file_name = f"{row_index:05d}_{safe_name}.pdf"
+        if archive is not None:
+            archive.write(pdf_path, arcname=file_name)
+        else:
+            page = len(self.pdf_writer.pages)
+            self.pdf_writer.append(pdf_path)
+            self.pdf_writer.add_outline_item(f"Row {row_index} - {client_name} - {amount}", page)
+        os.remove(pdf_path)
+        self.index.append((row_index, client_name, amount, file_name))
+
+    def __finish(self, archive):
+        if archive is not None:
+            index_file = io.StringIO()
+            writer = csv.writer(index_file)
+            writer.writerow(['Row', 'Client', 'Amount', 'File'])
+            writer.writerows(self.index)
+            archive.writestr('index.csv', index_file.getvalue())
+        else:
+            with replaced_atomically(self.output_path) as temp_path:
+                with open(temp_path, 'wb') as f:
+                    self.pdf_writer.write(f)
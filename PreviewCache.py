@@ -0,0 +1,120 @@
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+from RunJournal import RunJournal
+from logger import Logger
+from paths import replaced_atomically
+
+
+class PreviewCache:
+    MAX_BYTES = 200 * 1024 * 1024
+    EXTENSION = '.pdf'
+
+    def __init__(self, directory, max_bytes=MAX_BYTES):
+        # Preview PDFs stored by the hash of the payload they were rendered from, so an unchanged row is never
+        # downloaded twice. The least recently used files are removed once the store outgrows max_bytes.
+        self.logger = Logger.get_logger(__name__)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # payload hash -> size, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.__load()
+
+    @staticmethod
+    def key(values):
+        # The same hash the run journal records for the payload
+        return RunJournal.payload_hash(values)
+
+    def get(self, payload_hash, output_filepath):
+        with self.lock:
+            if payload_hash not in self.entries:
+                return False
+            self.entries.move_to_end(payload_hash)
+        cached_path = self.__path(payload_hash)
+        try:
+            # The access time is kept on disk, so the order survives between runs
+            os.utime(cached_path)
+            self.__copy(cached_path, output_filepath)
+        except OSError as e:
+            self.logger.warning("Dropping unreadable cached preview %s: %s", cached_path, e)
+            self.__remove(payload_hash)
+            return False
+        return True
+
+    def put(self, payload_hash, pdf_path):
+        try:
+            size = os.path.getsize(pdf_path)
+        except OSError:
+            return
+        if size > self.max_bytes:
+            return
+        try:
+            self.__copy(pdf_path, self.__path(payload_hash))
+        except OSError as e:
+            self.logger.error("Could not cache preview %s: %s", pdf_path, e)
+            return
+        with self.lock:
+            self.size += size - self.entries.pop(payload_hash, 0)
+            self.entries[payload_hash] = size
+        self.__trim()
+
+    def __trim(self):
+        evicted = []
+        with self.lock:
+            while self.size > self.max_bytes:
+                old_hash, old_size = self.entries.popitem(last=False)
+                self.size -= old_size
+                evicted.append(old_hash)
+        for old_hash in evicted:
+            self.__unlink(old_hash)
+        if evicted:
+            self.logger.debug("Evicted %s cached previews, %s bytes cached", len(evicted), self.size)
+
+    def __path(self, payload_hash):
+        return os.path.join(self.directory, f"{payload_hash}{self.EXTENSION}")
+
+    @staticmethod
+    def __copy(source, destination):
+        os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+        # Copied under a name of its own and swapped in, so a reader never sees a half-written file
+        with replaced_atomically(destination) as temp_path:
+            shutil.copyfile(source, temp_path)
+
+    def __remove(self, payload_hash):
+        with self.lock:
+            self.size -= self.entries.pop(payload_hash, 0)
+        self.__unlink(payload_hash)
+
+    def __unlink(self, payload_hash):
+        try:
+            os.remove(self.__path(payload_hash))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.logger.warning("Could not remove cached preview %s: %s", payload_hash, e)
+
+    def __load(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        entries = []
+        for name in names:
+            if not name.endswith(self.EXTENSION):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, name[:-len(self.EXTENSION)], stat.st_size))
+        for _, payload_hash, size in sorted(entries):
+            self.entries[payload_hash] = size
+            self.size += size
+        self.logger.debug("Loaded %s cached previews (%s bytes) from %s", len(self.entries), self.size,
+                          self.directory)
+        # The cap may have been lowered since the last run
+        self.__trim()
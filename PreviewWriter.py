@@ -0,0 +1,172 @@
+import base64
+import binascii
+import codecs
+import json
+import os
+import re
+
+
+class PreviewWriter:
+    CHUNK_SIZE = 64 * 1024
+    FILE_KEY = 'file'
+    SPECIAL = re.compile(r'["\\]')
+    ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        # Scans the top level of a JSON object read from `stream`, decoding the base64 'file' member
+        # to disk chunk by chunk; other scalar members are kept as metadata, nested values are skipped
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.position = 0
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def write(self, output_filepath):
+        os.makedirs(os.path.dirname(output_filepath) or '.', exist_ok=True)
+        temp_path = f"{output_filepath}.part"
+        metadata = {}
+        written = None
+        try:
+            self.__expect('{')
+            while True:
+                if self.__peek() == '}':
+                    break
+                key = self.__read_string()
+                self.__expect(':')
+                if key == self.FILE_KEY and self.__peek() == '"':
+                    with open(temp_path, 'wb') as output:
+                        written = self.__decode_file(output)
+                else:
+                    value = self.__read_value()
+                    if not isinstance(value, (dict, list)):
+                        metadata[key] = value
+                if self.__peek() == ',':
+                    self.position += 1
+                    continue
+                self.__expect('}')
+                break
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        if written is None:
+            return None, metadata
+        os.replace(temp_path, output_filepath)
+        return written, metadata
+
+    def __fill(self):
+        while self.position >= len(self.buffer):
+            chunk = self.stream.read(self.chunk_size)
+            if not chunk:
+                raise ValueError("Unexpected end of preview response")
+            # A multi-byte character split across chunks is held back by the incremental decoder
+            self.buffer = self.text_decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+            self.position = 0
+
+    def __find_special(self):
+        match = self.SPECIAL.search(self.buffer, self.position)
+        return match.start() if match else len(self.buffer)
+
+    def __peek(self):
+        while True:
+            self.__fill()
+            char = self.buffer[self.position]
+            if not char.isspace():
+                return char
+            self.position += 1
+
+    def __next(self):
+        self.__fill()
+        char = self.buffer[self.position]
+        self.position += 1
+        return char
+
+    def __expect(self, expected):
+        char = self.__peek()
+        if char != expected:
+            raise ValueError(f"Expected '{expected}' in preview response, got '{char}'")
+        self.position += 1
+
+    def __read_escape(self):
+        char = self.__next()
+        if char == 'u':
+            return chr(int(''.join(self.__next() for _ in range(4)), 16))
+        return self.ESCAPES[char]
+
+    def __read_string(self):
+        self.__expect('"')
+        parts = []
+        while True:
+            self.__fill()
+            end = self.__find_special()
+            parts.append(self.buffer[self.position:end])
+            self.position = end
+            if end == len(self.buffer):
+                continue
+            self.position += 1
+            if self.buffer[end] == '"':
+                return ''.join(parts)
+            parts.append(self.__read_escape())
+
+    def __read_value(self):
+        char = self.__peek()
+        if char == '"':
+            return self.__read_string()
+        if char in '{[':
+            self.__skip_container()
+            return {} if char == '{' else []
+        literal = []
+        while True:
+            self.__fill()
+            char = self.buffer[self.position]
+            if char in ',}]' or char.isspace():
+                return json.loads(''.join(literal))
+            literal.append(char)
+            self.position += 1
+
+    def __skip_container(self):
+        depth = 0
+        while True:
+            char = self.__peek()
+            if char == '"':
+                self.__read_string()
+                continue
+            self.position += 1
+            if char in '{[':
+                depth += 1
+            elif char in '}]':
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def __decode_file(self, output):
+        self.__expect('"')
+        pending = ''
+        written = 0
+        while True:
+            self.__fill()
+            end = self.__find_special()
+            pending += self.buffer[self.position:end]
+            self.position = end
+            closed = False
+            if end < len(self.buffer):
+                self.position += 1
+                if self.buffer[end] == '"':
+                    closed = True
+                else:
+                    pending += self.__read_escape()
+
+            # Line breaks some encoders insert into base64 are not part of the data
+            pending = ''.join(pending.split())
+            usable = len(pending) if closed else len(pending) - len(pending) % 4
+            if usable:
+                try:
+                    decoded = base64.b64decode(pending[:usable], validate=True)
+                except binascii.Error as e:
+                    raise ValueError(f"Invalid base64 in preview file: {e}") from e
+                output.write(decoded)
+                written += len(decoded)
+                pending = pending[usable:]
+            if closed:
+                return written
@@ -0,0 +1,64 @@
+import hashlib
+import json
+import threading
+
+from logger import Logger
+from paths import replaced_atomically
+
+
+class ProcessedRows:
+    def __init__(self, index_path, command):
+        # Fingerprint of every row a command completed, kept next to the input file, so a long-running watch
+        # only sends the rows that were added or edited since
+        self.logger = Logger.get_logger(__name__)
+        self.index_path = index_path
+        self.command = command
+        self.lock = threading.Lock()
+        # command -> {row index: fingerprint}
+        self.commands = {}
+        self.dirty = False
+        self.__load()
+
+    @property
+    def rows(self):
+        return self.commands.setdefault(self.command, {})
+
+    @staticmethod
+    def fingerprint(row):
+        # The Invoice column is left out, it is written by the app itself once a row is issued
+        content = row._replace(row_index=None, invoice=None)
+        return hashlib.sha256(json.dumps(list(content), default=str).encode('utf-8')).hexdigest()
+
+    def changed(self, row):
+        with self.lock:
+            return self.rows.get(str(row.row_index)) != self.fingerprint(row)
+
+    def mark(self, rows):
+        with self.lock:
+            for row in rows:
+                self.rows[str(row.row_index)] = self.fingerprint(row)
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            snapshot = json.dumps(self.commands)
+            self.dirty = False
+        try:
+            with replaced_atomically(self.index_path) as temp_path:
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    f.write(snapshot)
+        except OSError as e:
+            self.logger.error("Could not save processed rows: %s", e)
+
+    def __load(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self.commands = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.logger.warning("Ignoring unreadable row index %s: %s", self.index_path, e)
+            return
+        self.logger.debug("Loaded %s processed %s rows from %s", len(self.rows), self.command, self.index_path)
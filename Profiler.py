@@ -0,0 +1,58 @@
+import cProfile
+import io
+import pstats
+import threading
+import tracemalloc
+
+from logger import Logger
+
+
+class Profiler:
+    TRACEMALLOC_FRAMES = 10
+    TOP = 25
+
+    def __init__(self, output_prefix):
+        # Writes <prefix>.prof (load with pstats or snakeviz), <prefix>.tracemalloc (tracemalloc.Snapshot.load)
+        # and a readable <prefix>.txt with the slowest functions and the largest allocations
+        self.logger = Logger.get_logger(__name__)
+        self.output_prefix = output_prefix
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        tracemalloc.start(self.TRACEMALLOC_FRAMES)
+        self.enable_thread()
+
+    def enable_thread(self):
+        # cProfile only sees the thread that enabled it, so every worker thread gets its own profile
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Newer interpreters profile every thread from the first profile already
+            return
+        with self.lock:
+            self.profiles.append(profile)
+
+    def stop(self):
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        with self.lock:
+            profiles, self.profiles = self.profiles, []
+        for profile in profiles:
+            profile.disable()
+
+        report = io.StringIO()
+        stats = pstats.Stats(*profiles, stream=report) if profiles else None
+        if stats:
+            stats.dump_stats(f"{self.output_prefix}.prof")
+            stats.sort_stats('cumulative').print_stats(self.TOP)
+        snapshot.dump(f"{self.output_prefix}.tracemalloc")
+        report.write("Largest allocations:\n")
+        for statistic in snapshot.statistics('lineno')[:self.TOP]:
+            report.write(f"{statistic}\n")
+
+        with open(f"{self.output_prefix}.txt", 'w', encoding='utf-8') as f:
+            f.write(report.getvalue())
+        self.logger.info("Profile written to %s.prof, %s.tracemalloc and %s.txt", self.output_prefix,
+                         self.output_prefix, self.output_prefix)
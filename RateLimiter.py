@@ -0,0 +1,75 @@
+import threading
+import time
+from collections import deque
+
+
+class RateLimiter:
+    MIN_RATE = 0.5  # requests per second
+    INCREASE = 1.0  # requests per second regained every second without throttling
+    DECREASE = 0.5  # factor applied to the rate when the API throttles
+    DECREASE_INTERVAL = 1.0  # seconds, throttled responses of requests already in flight count once
+
+    def __init__(self, rate=None, burst=1, adaptive=False):
+        # Token bucket: `rate` requests per second on average, at most `burst` back to back, unlimited while
+        # rate is None. An adaptive limiter cuts its rate by DECREASE whenever the API throttles and grows it
+        # back by INCREASE per second (AIMD), never above the rate it started with.
+        self.rate = rate
+        self.max_rate = rate
+        self.adaptive = adaptive
+        self.capacity = max(1, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.decreased_at = 0.0
+        # Send times of the last second while unlimited, the rate to cut from when throttled for the first time
+        self.sent = deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.rate is None:
+                        self.__track(now)
+                        return
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self, retry_after=None):
+        with self.lock:
+            now = time.monotonic()
+            if retry_after:
+                # Nobody sends anything until the API said it is ready again
+                self.paused_until = max(self.paused_until, now + retry_after)
+            if not self.adaptive or now - self.decreased_at < self.DECREASE_INTERVAL:
+                return
+            current = self.rate if self.rate is not None else len(self.sent)
+            self.rate = max(self.MIN_RATE, current * self.DECREASE)
+            self.sent.clear()
+            self.tokens = 0
+            self.updated = max(now, self.paused_until)
+            self.decreased_at = now
+
+    def succeeded(self):
+        if not self.adaptive:
+            return
+        with self.lock:
+            if self.rate is None:
+                return
+            self.rate += self.INCREASE / self.rate
+            if self.max_rate is not None:
+                self.rate = min(self.max_rate, self.rate)
+
+    def __track(self, now):
+        if not self.adaptive:
+            return
+        self.sent.append(now)
+        while self.sent[0] < now - 1:
+            self.sent.popleft()
@@ -0,0 +1,135 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from DocumentIndex import DocumentIndex
+from GreenInvoiceHandler import GreenInvoiceHandler, RequestError
+from PayloadFile import PayloadFile
+from PaymentRow import RowError
+from RunJournal import RunJournal
+from Session import Session
+from logger import Logger
+
+
+class Replayer:
+    WORKERS = 4
+
+    def __init__(self, payload_path, workers=WORKERS, rate_limit=None, prefetch_clients=False,
+                 base_url=GreenInvoiceHandler.BASE_URL, metrics_output=None, session=None):
+        # Sends the documents of a dry-run payload file, streamed line by line with at most `workers` requests
+        # in flight. Documents already issued in the file's date range are matched first, as generate does, and
+        # outcomes are journaled in the source workbook's journal when it is on this machine, next to the
+        # payload file otherwise, so a replay can be repeated or resumed without issuing a document twice.
+        self.logger = Logger.get_logger(__name__)
+        self.payload_path = payload_path
+        self.workers = max(1, workers)
+        self.metrics_output = metrics_output
+        self.owns_session = session is None
+        self.session = session or Session(base_url=base_url, pool_size=self.workers, rate_limit=rate_limit,
+                                          prefetch_clients=prefetch_clients)
+        self.green_invoice_client = self.session.green_invoice_client
+        self.metrics = self.session.metrics
+        self.journal = None
+        self.document_index = None
+
+    def run(self):
+        self.session.connect_or_exit()
+
+        payload_file = PayloadFile(self.payload_path)
+        self.journal = RunJournal(self.__journal_path(payload_file.source()), 'replay')
+        failed = {}
+        issued = 0
+        in_flight = deque()
+        start = time.perf_counter()
+        try:
+            try:
+                self.document_index = self.__reconcile(payload_file)
+            except RequestError as e:
+                # Without the issued documents a replay could issue a row twice
+                self.logger.error("Could not fetch issued documents: %s", e)
+                return f"replay not started, could not fetch issued documents: {e}"
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for entry in payload_file:
+                    if entry.get('invoiced'):
+                        continue
+                    in_flight.append((entry, executor.submit(self.__send, entry)))
+                    while len(in_flight) >= self.workers * 2:
+                        issued += self.__collect(in_flight, failed)
+                while in_flight:
+                    issued += self.__collect(in_flight, failed)
+        finally:
+            self.journal.close()
+            self.session.save()
+            if self.owns_session:
+                self.session.report(self.metrics_output, 'Replay metrics')
+
+        self.logger.info("Replayed %s in %.2f seconds: %s issued, %s failed", self.payload_path,
+                         time.perf_counter() - start, issued, len(failed))
+        if failed:
+            rows = ", ".join(str(row_index) for row_index in sorted(failed, key=str))
+            return f"replay issued {issued} documents, {len(failed)} failed rows: {rows}"
+        return f"replay issued {issued} documents"
+
+    def __collect(self, in_flight, failed):
+        entry, future = in_flight.popleft()
+        try:
+            if future.result():
+                self.metrics.count('rows_done')
+                return 1
+            self.metrics.count('rows_skipped')
+        except (RowError, RequestError) as e:
+            self.logger.error("Row %s (%s) failed: %s", entry.get('row'), entry.get('client'), e)
+            failed[entry.get('row')] = str(e)
+            self.metrics.count('rows_failed')
+        return 0
+
+    def __journal_path(self, source):
+        # The workbook's own journal lets replay and generate see each other's documents
+        if source and os.path.exists(source):
+            return f"{source}.journal"
+        if source:
+            self.logger.info("%s is not on this machine, journaling next to %s", source, self.payload_path)
+        return f"{self.payload_path}.journal"
+
+    def __reconcile(self, payload_file):
+        # Documents issued by generate, another replay or another machine are never issued again
+        dates = []
+        invoiced = []
+        for entry in payload_file:
+            if entry.get('invoiced'):
+                invoiced.append((entry.get('client'), entry.get('date'), entry.get('amount')))
+            else:
+                dates.append(entry['values'].get('date'))
+        return DocumentIndex.reconcile(self.journal, invoiced, dates=dates,
+                                       search_documents=self.green_invoice_client.search_documents)
+
+    def __send(self, entry):
+        row_index = entry.get('row')
+        client_name = entry.get('client')
+        values = entry['values']
+        amount = sum(payment.get('price') or 0 for payment in values.get('payment') or [])
+        if self.document_index.claim_issued(self.journal, row_index, client_name, values.get('date'), amount):
+            self.metrics.count('rows_reconciled')
+            return False
+
+        client = values.setdefault('client', {})
+        if not client.get('id'):
+            # Not cached when the payloads were written
+            result = self.green_invoice_client.search_client_by_name(client_name)
+            if not result:
+                raise RowError(f"Client {client_name} not found")
+            client['id'], client_email = result
+            if client_email:
+                client['emails'] = [client_email]
+
+        payload_hash = self.journal.payload_hash(values)
+        issued = self.journal.begin_send(row_index, payload_hash, client=client_name, client_id=client['id'])
+        if issued:
+            self.logger.warning("Row %s matches document %s issued from row %s, not issuing it again",
+                                row_index, issued.get('document_id'), issued['row'])
+            return False
+        self.journal.send(row_index, payload_hash,
+                          lambda: self.green_invoice_client.generate_new_invoice(values, client_name),
+                          client=client_name, client_id=client['id'], date=values.get('date'), amount=amount)
+        return True
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+from DocumentIndex import DocumentIndex
+from PaymentRow import RowError
+from logger import Logger
+
+
+class RunJournal:
+    SUCCESS_STATUSES = ('issued', 'previewed', 'checked')
+
+    def __init__(self, journal_path, command, resume=False):
+        self.logger = Logger.get_logger(__name__)
+        self.journal_path = journal_path
+        self.command = command
+        self.run_id = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        self.lock = threading.Lock()
+
+        # payload hash -> issued entries of earlier runs that no row of this run accounts for yet. Rows move when
+        # the sheet is sorted or edited, so only the payload proves a row was issued, never its position. Two
+        # equal payments are two documents, so every entry covers a single row, like a DocumentIndex claim.
+        self.unclaimed = {}
+        # (client, date, amount) -> payload hashes, and document id -> payload hash, of the unclaimed entries
+        self.hashes_by_key = {}
+        self.hashes_by_document = {}
+        # payload hashes that were sent to /documents without a recorded outcome
+        self.uncertain = set()
+        # (row, client) pairs completed by the run being resumed
+        self.completed = set()
+        # payload hash -> row of the documents this process is sending right now
+        self.sending = {}
+        self.send_lock = threading.Condition()
+        self.__load(resume)
+
+        self.file = open(journal_path, 'a', encoding='utf-8')
+        self.__append({'event': 'start', 'command': command, 'resume': resume})
+
+    @staticmethod
+    def payload_hash(values):
+        payload = json.dumps(values, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def is_completed(self, row_index, client_name):
+        return (row_index, client_name) in self.completed
+
+    def claim(self, payload_hash):
+        # Takes an issued entry of this payload for the calling row, None once every entry is accounted for
+        with self.send_lock:
+            return self.__take(payload_hash)
+
+    def claim_invoiced(self, client, date, amount, document=None):
+        # An invoiced row accounts for its own entry first, by the document matched to it or by its content, so
+        # the entry is not taken by an equal row that still has to be issued
+        with self.send_lock:
+            if document is not None:
+                payload_hash = self.hashes_by_document.get(document.get('id'))
+                return self.__take(payload_hash, document.get('id')) if payload_hash else None
+            for payload_hash in list(self.hashes_by_key.get(DocumentIndex.key(client, date, amount), ())):
+                entry = self.__take(payload_hash)
+                if entry is not None:
+                    return entry
+            return None
+
+    def claim_document(self, row_index, client, document):
+        # A row matched to a document found by the API is journaled as issued by it, and accounts for the
+        # journal entry of that document if an earlier run issued it
+        document_id = document.get('id')
+        with self.send_lock:
+            payload_hash = self.hashes_by_document.get(document_id)
+            if payload_hash:
+                self.__take(payload_hash, document_id)
+        self.record(row_index, 'issued', client=client, client_id=(document.get('client') or {}).get('id'),
+                    document_id=document_id)
+
+    def begin_send(self, row_index, payload_hash, client=None, client_id=None):
+        # Returns the issued entry this row accounts for, or None once 'sending' is recorded and the document
+        # can be sent. A row waits for a document of the same payload that is being sent, which is then
+        # accounted for by its own row. A payload sent without a recorded outcome cannot be sent safely.
+        with self.send_lock:
+            while payload_hash in self.sending:
+                self.send_lock.wait()
+            issued = self.__take(payload_hash)
+            if issued is not None:
+                return issued
+            if payload_hash in self.uncertain:
+                raise RowError(f"A document for row {row_index} was sent without a recorded outcome, "
+                               f"check it was not issued before clearing {self.journal_path}")
+            self.sending[payload_hash] = row_index
+            # Written before sending, so a crash mid-request can never lead to issuing the document twice
+            self.record(row_index, 'sending', client=client, client_id=client_id, payload_hash=payload_hash)
+        return None
+
+    def send(self, row_index, payload_hash, request, client=None, client_id=None, date=None, amount=None):
+        # Sends a payload cleared by begin_send and journals the outcome as soon as it is known
+        try:
+            try:
+                document = request()
+            except Exception as e:
+                # Only an answer from the API proves the document was not issued, otherwise the payload stays
+                # uncertain
+                answered = getattr(e, 'status', None) is not None
+                self.record(row_index, 'failed', client=client, payload_hash=payload_hash if answered else None,
+                            error=e)
+                raise
+            self.record(row_index, 'issued', client=client, client_id=client_id, payload_hash=payload_hash,
+                        document_id=(document or {}).get('id'), date=date, amount=amount)
+            return document
+        finally:
+            # Released only once the outcome is journaled
+            with self.send_lock:
+                self.sending.pop(payload_hash, None)
+                self.send_lock.notify_all()
+
+    def record(self, row_index, status, client=None, client_id=None, payload_hash=None, document_id=None,
+               error=None, date=None, amount=None):
+        entry = {'event': 'row', 'row': row_index, 'status': status, 'client': client, 'client_id': client_id,
+                 'payload_hash': payload_hash, 'document_id': document_id, 'date': date, 'amount': amount,
+                 'error': str(error) if error is not None else None}
+        entry = {key: value for key, value in entry.items() if value is not None}
+        self.__append(entry)
+        self.__apply(entry)
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+    def __append(self, entry):
+        entry = dict(entry, run=self.run_id, time=time.time())
+        line = json.dumps(entry, ensure_ascii=False, default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def __apply(self, entry, loading=False):
+        payload_hash = entry.get('payload_hash')
+        if entry['status'] == 'sending':
+            self.uncertain.add(payload_hash)
+        elif entry['status'] in ('issued', 'failed'):
+            self.uncertain.discard(payload_hash)
+        # A document issued by this run is accounted for by the row that sent it
+        if loading and entry['status'] == 'issued' and payload_hash:
+            self.unclaimed.setdefault(payload_hash, []).append(entry)
+            if 'date' in entry:
+                key = DocumentIndex.key(entry.get('client'), entry['date'], entry.get('amount'))
+                self.hashes_by_key.setdefault(key, set()).add(payload_hash)
+            if entry.get('document_id'):
+                self.hashes_by_document[entry['document_id']] = payload_hash
+
+    def __take(self, payload_hash, document_id=None):
+        entries = self.unclaimed.get(payload_hash)
+        if not entries:
+            return None
+        if document_id is None:
+            return entries.pop(0)
+        for position, entry in enumerate(entries):
+            if entry.get('document_id') == document_id:
+                return entries.pop(position)
+        return None
+
+    def __load(self, resume):
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+
+        run_commands = {}
+        chains = {}
+        for line_number, line in enumerate(lines, start=1):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A crash mid-write leaves at most one torn line
+                self.logger.warning("Ignoring unreadable line %s of %s", line_number, self.journal_path)
+                continue
+
+            if entry.get('event') == 'start':
+                run_commands[entry['run']] = entry['command']
+                if not entry.get('resume'):
+                    chains[entry['command']] = set()
+            elif entry.get('event') == 'row':
+                self.__apply(entry, loading=True)
+                if entry['status'] in self.SUCCESS_STATUSES:
+                    command = run_commands.get(entry['run'])
+                    chains.setdefault(command, set()).add((entry['row'], entry.get('client')))
+
+        if resume:
+            self.completed = chains.get(self.command, set())
+            if self.completed:
+                last_row = max(row for row, _ in self.completed)
+                self.logger.info("Resuming %s: %s rows already done, last committed row %s",
+                                 self.command, len(self.completed), last_row)
+        if self.uncertain:
+            self.logger.warning("%s documents were sent without a recorded outcome, their rows will not be issued "
+                                "again", len(self.uncertain))
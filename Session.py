@@ -0,0 +1,136 @@
+import hashlib
+import os
+import threading
+
+from ClientCache import ClientCache
+from GreenInvoiceHandler import GreenInvoiceHandler, RequestError
+from Metrics import Metrics
+from PreviewCache import PreviewCache
+from RateLimiter import RateLimiter
+from TokenManager import TokenManager
+from logger import Logger
+from paths import app_directory
+from readers import open_reader
+
+
+class Session:
+    CREDENTIALS_PATH = "Samples/Credentials.yml"
+
+    def __init__(self, base_url=GreenInvoiceHandler.BASE_URL, pool_size=1, rate_limit=None, prefetch_clients=False,
+                 preview_dir=GreenInvoiceHandler.PREVIEW_DIRECTORY, credentials_path=CREDENTIALS_PATH,
+                 preview_cache_size=PreviewCache.MAX_BYTES, keep_files=False):
+        # Everything that outlives a single workbook: credentials, token, client cache, connection pool,
+        # rate limiter and metrics. Any number of InvoiceApps can run on one session at the same time.
+        self.logger = Logger.get_logger(__name__)
+        self.prefetch_clients = prefetch_clients
+        self.metrics = Metrics()
+
+        self.key, self.secret = self.__read_cred(credentials_path)
+        self.client_cache = ClientCache(self.__account_path('clients'))
+        # A size of 0 turns the preview cache off
+        self.preview_cache = None
+        if preview_cache_size:
+            self.preview_cache = PreviewCache(app_directory('Cache', 'Previews'), preview_cache_size)
+        self.green_invoice_client = GreenInvoiceHandler(self.key, self.secret, base_url=base_url,
+                                                        pool_size=max(1, pool_size),
+                                                        rate_limiter=RateLimiter(rate_limit, adaptive=True),
+                                                        client_cache=self.client_cache,
+                                                        token_manager=TokenManager(self.__account_path('token')),
+                                                        preview_directory=preview_dir, metrics=self.metrics,
+                                                        preview_cache=self.preview_cache)
+        # The token is only fetched by connect, or by the first run
+        self.connected = False
+        self.connect_lock = threading.Lock()
+        # With keep_files, parsed files are kept for the next run until the file changes on disk:
+        # (path, streaming, mapping) -> (reader, (mtime, size) when it was read)
+        self.keep_files = keep_files
+        self.files = {}
+        self.files_lock = threading.Lock()
+
+    def connect(self):
+        with self.connect_lock:
+            if self.connected:
+                return
+            self.green_invoice_client.generate_token()
+            if self.prefetch_clients:
+                self.green_invoice_client.prefetch_clients()
+            self.connected = True
+
+    def connect_or_exit(self):
+        try:
+            self.connect()
+        except RequestError as e:
+            self.logger.critical("Could not connect to Green Invoice: %s", e)
+            exit(-1)
+
+    def report(self, metrics_output=None, title='Run metrics', results=None):
+        # Printed and logged once by whoever owns the session, optionally after a summary of its own
+        summary = self.metrics.summary()
+        if results:
+            summary = f"{results}\n\n{summary}"
+        self.logger.info("%s:\n%s", title, summary)
+        print(summary)
+        if metrics_output:
+            try:
+                self.metrics.write(metrics_output)
+            except OSError as e:
+                self.logger.error("Could not write metrics to %s: %s", metrics_output, e)
+
+    def open_file(self, file_path, streaming=False, mapping=None):
+        if not self.keep_files:
+            return open_reader(file_path, streaming=streaming, metrics=self.metrics, mapping=mapping)
+        key = (os.path.abspath(file_path), streaming, self.__mapping_key(mapping))
+        with self.files_lock:
+            signature = self.__file_signature(file_path)
+            entry = self.files.get(key)
+            # Writing the Invoice column back changes the file as well, so a file written by a run is read again
+            if entry is not None and signature is not None and entry[1] == signature:
+                self.logger.debug("Reusing %s, unchanged since it was read", file_path)
+                self.metrics.count('file_reuses')
+                return entry[0]
+            reader = open_reader(file_path, streaming=streaming, metrics=self.metrics, mapping=mapping)
+            self.files[key] = (reader, signature)
+            return reader
+
+    def save(self):
+        self.client_cache.save()
+
+    def close(self):
+        self.save()
+        self.green_invoice_client.close()
+
+    @staticmethod
+    def __file_signature(file_path):
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    def __mapping_key(mapping):
+        if mapping is None:
+            return None
+        return mapping.sheet_name, mapping.date_format, tuple(sorted(mapping.columns.items()))
+
+    def __account_path(self, name):
+        # One file per account, so switching credentials never mixes tokens or client ids
+        account = hashlib.sha256(str(self.key).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(app_directory('Cache'), f"{name}_{account}.json")
+
+    def __read_cred(self, file_path):
+        import yaml
+        try:
+            with open(file_path, 'r') as f:
+                creds = yaml.safe_load(f)
+
+            key = creds.get('key')
+            secret = creds.get('secret')
+
+            return key, secret
+        except FileNotFoundError as fileNotFoundErr:
+            self.logger.error("error in opening cred file: %s", fileNotFoundErr)
+            exit(-1)
+        except:
+            self.logger.error("Unexpected error in opening file: %s", file_path)
+            exit(-1)
@@ -0,0 +1,157 @@
+import json
+import os
+import threading
+
+from ColumnMapping import ColumnMapping
+from Metrics import Metrics
+from logger import Logger
+
+
+class SheetReader:
+    FLUSH_EVERY = 25
+    FLUSH_INTERVAL = 30  # seconds
+
+    def __init__(self, file_path, flush_every=FLUSH_EVERY, flush_interval=FLUSH_INTERVAL, metrics=None,
+                 mapping=None, streaming=False):
+        # Common part of every input format: rows are sequences indexed through self.columns, and fields are
+        # looked up by name through the column mapping. Subclasses implement load_data and save_data.
+        self.logger = Logger.get_logger(type(self).__name__)
+        self.metrics = metrics or Metrics()
+        self.mapping = mapping or ColumnMapping()
+        self.data = []
+        self.headers = []
+        self.columns = {}
+        self.file_path = file_path
+        # In streaming mode rows are read lazily by iter_rows instead of being materialized into self.data
+        self.streaming = streaming
+        self.stream_open = False
+        self.row_count = 0
+        # Rows marked as invoiced are appended here before the file itself is updated,
+        # so an issued invoice is never lost if the process dies between flushes
+        self.pending_path = f"{file_path}.pending"
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.dirty_rows = set()
+        # Streaming mode keeps the content key of each row that may still be invoiced, see row_key
+        self.row_keys = {}
+        self.lock = threading.RLock()
+        self.flush_timer = None
+        with self.metrics.time('workbook_load'):
+            self.load_data()
+        self.__replay_pending()
+
+    def load_data(self):
+        raise NotImplementedError
+
+    def save_data(self):
+        # Writes the invoice status of self.dirty_rows to the file, returns whether it succeeded
+        raise NotImplementedError
+
+    def set_headers(self, headers):
+        self.headers = list(headers)
+        self.columns = {header: col_idx for col_idx, header in enumerate(self.headers) if header is not None}
+
+    def index_of(self, field):
+        return self.columns.get(self.mapping.header(field))
+
+    def iter_rows(self):
+        yield from enumerate(self.data)
+
+    def row_key(self, row):
+        # Client, date and amount of a row, stored with each pending entry so a recovery only marks a row whose
+        # content is still the same, and not whatever row was moved to its index since
+        key = []
+        for field in ('client', 'date_paid', 'amount_paid'):
+            col_idx = self.index_of(field)
+            value = row[col_idx] if col_idx is not None and col_idx < len(row) else None
+            key.append(None if value is None else str(value))
+        return key
+
+    def change_invoice_status(self, row_index: int):
+        try:
+            if 0 <= row_index < self.row_count:
+                with self.lock:
+                    invoice_idx = self.index_of('invoice')
+                    if self.streaming:
+                        key = self.row_keys.get(row_index)
+                    else:
+                        key = self.row_key(self.data[row_index])
+                        if invoice_idx is not None:
+                            self.data[row_index][invoice_idx] = True
+                    self.__record_pending(row_index, key)
+                    self.dirty_rows.add(row_index)
+                    self.logger.debug("Changed invoice status of row %s to True", row_index)
+                    if len(self.dirty_rows) >= self.flush_every:
+                        self.flush()
+                    elif self.flush_timer is None:
+                        self.flush_timer = threading.Timer(self.flush_interval, self.flush)
+                        self.flush_timer.daemon = True
+                        self.flush_timer.start()
+            else:
+                raise IndexError(f"Error: Index out of range: {row_index}")
+        except IndexError as e:
+            self.logger.error(e)
+
+    def flush(self):
+        with self.lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            # The pending file already covers these rows; the file is rewritten once the stream closes
+            if not self.dirty_rows or self.stream_open:
+                return
+            with self.metrics.time('workbook_save'):
+                saved = self.save_data()
+            if saved:
+                self.logger.debug("Flushed invoice status of %s rows", len(self.dirty_rows))
+                self.dirty_rows.clear()
+                self.__clear_pending()
+
+    def __record_pending(self, row_index, key):
+        with open(self.pending_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'row': row_index, 'key': key}, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def __clear_pending(self):
+        try:
+            os.remove(self.pending_path)
+        except FileNotFoundError:
+            pass
+
+    def __replay_pending(self):
+        pending = {}
+        try:
+            with open(self.pending_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = json.loads(line)
+                        pending[int(entry['row'])] = entry['key']
+                    except (ValueError, TypeError, KeyError) as e:
+                        self.logger.warning("Ignoring unreadable line of %s: %s", self.pending_path, e)
+        except FileNotFoundError:
+            return
+        self.logger.warning("Recovering invoice status of %s rows from %s", len(pending), self.pending_path)
+
+        invoice_idx = self.index_of('invoice')
+        for row_index, row in self.iter_rows():
+            if row_index not in pending:
+                continue
+            if pending.pop(row_index) != self.row_key(row):
+                # The sheet was edited since; the journal's payload hash or the reconciliation with the issued
+                # documents decides about this row instead
+                self.logger.warning("Not recovering the invoice status of row %s, its content changed since",
+                                    row_index)
+                continue
+            if not self.streaming and invoice_idx is not None:
+                self.data[row_index][invoice_idx] = True
+            self.dirty_rows.add(row_index)
+        for row_index in pending:
+            self.logger.warning("Not recovering the invoice status of row %s, it is no longer in %s",
+                                row_index, self.file_path)
+        if self.dirty_rows:
+            self.flush()
+        else:
+            self.__clear_pending()
@@ -0,0 +1,80 @@
+import base64
+import json
+import os
+import threading
+import time
+
+from logger import Logger
+
+
+class TokenManager:
+    REFRESH_MARGIN = 5 * 60  # seconds before expiry at which the token is renewed
+    DEFAULT_LIFETIME = 60 * 60  # seconds, used when the expiry cannot be determined
+
+    def __init__(self, token_path=None, refresh_margin=REFRESH_MARGIN):
+        self.logger = Logger.get_logger(__name__)
+        self.token_path = token_path
+        self.refresh_margin = refresh_margin
+        self.token = None
+        self.expires_at = 0
+        self.lock = threading.Lock()
+        self.__load()
+
+    def valid_token(self):
+        with self.lock:
+            if self.token and time.time() < self.expires_at - self.refresh_margin:
+                return self.token
+            return None
+
+    def store(self, token, expires_at=None):
+        expires_at = self.token_expiry(token) or expires_at or time.time() + self.DEFAULT_LIFETIME
+        with self.lock:
+            self.token = token
+            self.expires_at = float(expires_at)
+        self.logger.debug("Stored token valid until %s", time.ctime(self.expires_at))
+        self.__save()
+
+    def invalidate(self, token):
+        # Only drop the token that was actually rejected, another thread may have refreshed it already
+        with self.lock:
+            if self.token != token:
+                return
+            self.token = None
+            self.expires_at = 0
+        self.__save()
+
+    @staticmethod
+    def token_expiry(token):
+        try:
+            payload = token.split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+        except (IndexError, KeyError, TypeError, ValueError):
+            return None
+
+    def __load(self):
+        if not self.token_path:
+            return
+        try:
+            with open(self.token_path, 'r') as f:
+                stored = json.load(f)
+            self.token = stored['token']
+            self.expires_at = float(stored['expires_at'])
+        except FileNotFoundError:
+            return
+        except (OSError, KeyError, TypeError, ValueError) as e:
+            self.logger.warning("Ignoring unreadable token cache %s: %s", self.token_path, e)
+
+    def __save(self):
+        if not self.token_path:
+            return
+        with self.lock:
+            stored = {'token': self.token, 'expires_at': self.expires_at}
+        try:
+            # Readable by the current user only
+            fd = os.open(self.token_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(stored, f)
+            os.chmod(self.token_path, 0o600)
+        except OSError as e:
+            self.logger.error("Could not save token cache: %s", e)
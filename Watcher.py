@@ -0,0 +1,86 @@
+import os
+import threading
+import time
+
+from GreenInvoiceHandler import GreenInvoiceHandler
+from PreviewCache import PreviewCache
+from ProcessedRows import ProcessedRows
+from Session import Session
+from invoiceApp import InvoiceApp
+from logger import Logger
+
+
+class Watcher:
+    POLL_INTERVAL = 5  # seconds
+    SETTLE_TIME = 2  # seconds a file must stay unchanged before it is read, so a save in progress is never read
+
+    def __init__(self, command, file_path, interval=POLL_INTERVAL, streaming=False, workers=1, rate_limit=None,
+                 prefetch_clients=False, preview_dir=GreenInvoiceHandler.PREVIEW_DIRECTORY,
+                 base_url=GreenInvoiceHandler.BASE_URL, metrics_output=None, reconcile=True, column_mapping=None,
+                 preview_cache_size=PreviewCache.MAX_BYTES):
+        self.logger = Logger.get_logger(__name__)
+        self.command = command
+        self.file_path = file_path or input("Please enter the path to the input file: ")
+        self.interval = interval
+        self.app_options = {'streaming': streaming, 'workers': workers, 'preview_dir': preview_dir,
+                            'reconcile': reconcile, 'column_mapping': column_mapping}
+        self.metrics_output = metrics_output
+        # Kept for the whole watch: the token, the connection pool and the client and preview caches stay warm
+        # between runs
+        self.session = Session(base_url=base_url, pool_size=max(workers, InvoiceApp.CLIENT_WORKERS),
+                               rate_limit=rate_limit, prefetch_clients=prefetch_clients, preview_dir=preview_dir,
+                               preview_cache_size=preview_cache_size)
+        self.metrics = self.session.metrics
+        self.processed_rows = ProcessedRows(f"{self.file_path}.rows", command)
+        self.stop_event = threading.Event()
+        self.runs = 0
+
+    def run(self):
+        self.logger.info("Watching %s for new rows to %s, every %s seconds", self.file_path, self.command,
+                         self.interval)
+        self.session.connect_or_exit()
+
+        last_change = None
+        try:
+            while not self.stop_event.is_set():
+                change = self.__last_change()
+                if change is not None and change != last_change and time.time() - change[0] >= self.SETTLE_TIME:
+                    last_change = change
+                    # Writing the Invoice column back changes the file too; the run that follows finds no new
+                    # rows and sends nothing, while an edit saved during this run is still picked up
+                    self.run_once()
+                self.stop_event.wait(self.interval)
+        except KeyboardInterrupt:
+            self.logger.info("Stopped watching %s", self.file_path)
+        finally:
+            self.session.close()
+            self.session.report(self.metrics_output, 'Watch metrics')
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run_once(self):
+        self.runs += 1
+        self.logger.info("%s changed, run %s", self.file_path, self.runs)
+        app = InvoiceApp(self.command, self.file_path, session=self.session, processed_rows=self.processed_rows,
+                         **self.app_options)
+        try:
+            result = app.run()
+        except SystemExit:
+            # An unreadable workbook or an invoice issued out of order only ends this run
+            result = f"{self.command} stopped, see the log for details"
+        except Exception as e:
+            self.logger.error("%s failed on %s: %s", self.command, self.file_path, e)
+            result = f"{self.command} failed: {e}"
+        if isinstance(result, set):
+            result = f"{len(result)} missing clients: {', '.join(sorted(result))}"
+        self.logger.info("Run %s: %s", self.runs, result)
+        print(result)
+        return result
+
+    def __last_change(self):
+        try:
+            stat = os.stat(self.file_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime, stat.st_size
@@ -0,0 +1,159 @@
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Smallest well-formed single page PDF, returned by /documents/preview
+BLANK_PDF = (b"%PDF-1.4\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n"
+             b"2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj\n"
+             b"3 0 obj<</Type/Page/Parent 2 0 R/MediaBox[0 0 200 200]>>endobj\n"
+             b"trailer<</Root 1 0 R>>\n%%EOF\n")
+
+
+class FakeGreenInvoiceAPI:
+    def __init__(self, clients=(), latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1,
+                 preview_size=len(BLANK_PDF), seed=None, rate_limit=None):
+        # Local stand-in for the Green Invoice endpoints the app uses. Every request sleeps for
+        # latency +- jitter seconds; error_rate answers 500 and throttle_rate answers 429 with Retry-After.
+        # rate_limit answers 429 to every request beyond that many within the same second.
+        self.rate_limit = rate_limit
+        self.window = (0, 0)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.preview_file = base64.b64encode(BLANK_PDF + b' ' * max(0, preview_size - len(BLANK_PDF))).decode()
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.token = None
+        self.clients = {}
+        self.documents = []
+        self.requests = {}
+        for name in clients:
+            self.add_client(name)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.__handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_port}/api/v1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='FakeGreenInvoiceAPI', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def add_client(self, name, emails=()):
+        client = {'id': str(uuid.uuid4()), 'name': name, 'emails': list(emails), 'active': True}
+        with self.lock:
+            self.clients[client['id']] = client
+        return client
+
+    def handle(self, end_point, values, headers):
+        with self.lock:
+            self.requests[end_point] = self.requests.get(end_point, 0) + 1
+            roll = self.random.random()
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            second = int(time.monotonic())
+            self.window = (second, self.window[1] + 1 if self.window[0] == second else 1)
+            over_limit = self.rate_limit is not None and self.window[1] > self.rate_limit
+        time.sleep(delay)
+
+        if over_limit or roll < self.throttle_rate:
+            return 429, {'errorCode': 429, 'errorMessage': 'Too many requests'}, \
+                {'Retry-After': str(self.retry_after)}
+        if roll < self.throttle_rate + self.error_rate:
+            return 500, {'errorCode': 500, 'errorMessage': 'Internal error'}, {}
+
+        if end_point == '/account/token':
+            self.token = uuid.uuid4().hex
+            return 200, {'token': self.token, 'expires': int(time.time()) + 3600}, {}
+        if headers.get('Authorization') != f"Bearer {self.token}":
+            return 401, {'errorCode': 401, 'errorMessage': 'Unauthorized'}, {}
+
+        if end_point == '/clients/search':
+            return 200, self.__search_clients(values), {}
+        if end_point == '/clients':
+            return 201, self.add_client(values['name'], values.get('emails', ())), {}
+        if end_point == '/documents/search':
+            return 200, self.__search_documents(values), {}
+        if end_point in ('/documents', '/documents/preview') and \
+                (values.get('client') or {}).get('id') not in self.clients:
+            return 400, {'errorCode': 400, 'errorMessage': 'Unknown client'}, {}
+        if end_point == '/documents/preview':
+            return 200, {'file': self.preview_file}, {}
+        if end_point == '/documents':
+            with self.lock:
+                client = dict(values.get('client') or {})
+                client['name'] = self.clients.get(client.get('id'), {}).get('name')
+                document = {'id': str(uuid.uuid4()), 'number': len(self.documents) + 1, 'type': values.get('type'),
+                            'documentDate': values.get('date'), 'client': client,
+                            'amount': sum(payment.get('price', 0) for payment in values.get('payment', []))}
+                self.documents.append(document)
+            return 201, {'id': document['id'], 'number': document['number']}, {}
+        return 404, {'errorCode': 404, 'errorMessage': f"Unknown endpoint {end_point}"}, {}
+
+    def __search_clients(self, values):
+        with self.lock:
+            clients = [client for client in self.clients.values()
+                       if values.get('name') is None or client['name'] == values['name']]
+        return self.__page(clients, values)
+
+    @staticmethod
+    def __page(items, values):
+        page = int(values.get('page', 1))
+        page_size = int(values.get('pageSize', 25))
+        return {'total': len(items), 'page': page, 'pageSize': page_size,
+                'pages': (len(items) + page_size - 1) // page_size,
+                'items': items[(page - 1) * page_size:page * page_size]}
+
+    def __search_documents(self, values):
+        with self.lock:
+            documents = [document for document in self.documents
+                         if values.get('fromDate', '') <= (document['documentDate'] or '') <= values.get('toDate', '~')
+                         and (not values.get('type') or document['type'] in values['type'])]
+        return self.__page(documents, values)
+
+    def __handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out in separate writes; without this, delayed ACKs add ~40ms per response
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                values = json.loads(self.rfile.read(length) or b'{}')
+                end_point = self.path[len('/api/v1'):] if self.path.startswith('/api/v1') else self.path
+                status, body, headers = api.handle(end_point, values, self.headers)
+
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
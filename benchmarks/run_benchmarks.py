@@ -0,0 +1,147 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+COMMANDS = ['checkClient', 'preview', 'generate']
+
+
+class TimedTransport:
+    def __init__(self, transport):
+        # Wraps the handler's transport and records the latency of every request per endpoint
+        self.transport = transport
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def request(self, method, end_point, body=None, headers=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.transport.request(method, end_point, body, headers, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.samples.setdefault(end_point, []).append(elapsed)
+
+    def close(self):
+        self.transport.close()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_case(work_directory, workbook, command, base_url, options):
+    from invoiceApp import InvoiceApp
+
+    app = InvoiceApp(command, workbook, base_url=base_url, preview_dir=os.path.join(work_directory, 'previews'),
+                     **options)
+    transport = TimedTransport(app.green_invoice_client.transport)
+    app.green_invoice_client.transport = transport
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = app.run()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies = [sample for samples in transport.samples.values() for sample in samples]
+    return {
+        'command': command,
+        'seconds': elapsed,
+        'rows_per_second': app.file.row_count / elapsed if elapsed else 0.0,
+        'requests': len(latencies),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'endpoints': {end_point: {'requests': len(samples),
+                                  'p50_ms': percentile(samples, 0.50) * 1000,
+                                  'p99_ms': percentile(samples, 0.99) * 1000}
+                      for end_point, samples in transport.samples.items()},
+        'peak_memory_mb': peak / (1024 * 1024),
+        'metrics': app.metrics.to_dict(),
+        'result': result if isinstance(result, str) else f"{len(result)} missing clients",
+    }
+
+
+def run_size(rows, args):
+    from benchmarks.fake_api import FakeGreenInvoiceAPI
+    from benchmarks.workbook_generator import generate_workbook
+
+    work_directory = tempfile.mkdtemp(prefix=f"bench_{rows}_")
+    try:
+        os.makedirs(os.path.join(work_directory, 'Samples'))
+        with open(os.path.join(work_directory, 'Samples', 'Credentials.yml'), 'w') as f:
+            f.write("key: benchmark\nsecret: benchmark\n")
+        workbook = os.path.join(work_directory, 'payments.xlsx')
+        names = generate_workbook(workbook, rows, seed=args.seed)
+
+        options = {'workers': args.workers, 'streaming': args.streaming}
+        results = []
+        with FakeGreenInvoiceAPI(names, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                                 throttle_rate=args.throttle_rate, seed=args.seed,
+                                 rate_limit=args.server_rate_limit) as api:
+            cwd = os.getcwd()
+            os.chdir(work_directory)
+            try:
+                for command in args.commands:
+                    result = run_case(work_directory, workbook, command, api.base_url, options)
+                    result['rows'] = rows
+                    results.append(result)
+            finally:
+                os.chdir(cwd)
+        return results
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+
+def print_table(results):
+    header = f"{'rows':>7} {'command':<12} {'seconds':>9} {'rows/s':>9} {'requests':>9} {'p50 ms':>8} " \
+             f"{'p99 ms':>8} {'peak MB':>8}  result"
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        print(f"{result['rows']:>7} {result['command']:<12} {result['seconds']:>9.2f} "
+              f"{result['rows_per_second']:>9.1f} {result['requests']:>9} {result['p50_ms']:>8.2f} "
+              f"{result['p99_ms']:>8.2f} {result['peak_memory_mb']:>8.1f}  {result['result'].splitlines()[0]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmarks against a local Green Invoice stand-in')
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--commands', nargs='+', choices=COMMANDS, default=COMMANDS)
+    parser.add_argument('--latency', type=float, default=0.005, help='Simulated API latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.002)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--server-rate-limit', type=int, default=None,
+                        help='Requests per second the stand-in accepts before answering 429')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', default=None, help='Also write the results to this file')
+    args = parser.parse_args()
+
+    results = []
+    for rows in args.rows:
+        results.extend(run_size(rows, args))
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    # Keep tokens, client caches and logs of benchmark runs away from the real ones
+    os.environ.setdefault('GREENINVOICE_HOME', tempfile.mkdtemp(prefix='greeninvoice_bench_'))
+    main()
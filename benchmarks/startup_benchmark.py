@@ -0,0 +1,101 @@
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Every case runs in a fresh interpreter, so nothing is already imported or cached
+CASES = {
+    'import invoiceApp': "import invoiceApp",
+    'import InvoiceAppGUI': "import InvoiceAppGUI",
+    'construct InvoiceApp': "from invoiceApp import InvoiceApp\n"
+                            "InvoiceApp('checkClient', 'payments.xlsx', base_url='http://127.0.0.1:9/api/v1')",
+}
+# Heavy modules that must not be loaded before a command needs them
+DEFERRED_MODULES = ['openpyxl', 'pyarrow', 'yaml', 'green_invoice', 'requests', 'tkinter']
+# Modules a case is expected to load
+EXPECTED_MODULES = {
+    'import InvoiceAppGUI': ['tkinter'],
+    'construct InvoiceApp': ['yaml'],  # Credentials are read when the app is created
+}
+
+MEASURE = """
+import sys, time, json
+sys.path.insert(0, {repo_root!r})
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'ms': elapsed * 1000, 'loaded': [name for name in {deferred!r} if name in sys.modules]}}))
+"""
+
+
+def measure(statement, work_directory, environment):
+    script = MEASURE.format(repo_root=REPO_ROOT, statement=statement, deferred=DEFERRED_MODULES)
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', script], cwd=work_directory, env=environment,
+                            capture_output=True, text=True, check=True).stdout
+    process_ms = (time.perf_counter() - start) * 1000
+    result = json.loads(output.strip().splitlines()[-1])
+    result['process_ms'] = process_ms
+    return result
+
+
+def run_cases(args):
+    work_directory = tempfile.mkdtemp(prefix='startup_')
+    try:
+        os.makedirs(os.path.join(work_directory, 'Samples'))
+        with open(os.path.join(work_directory, 'Samples', 'Credentials.yml'), 'w') as f:
+            f.write("key: benchmark\nsecret: benchmark\n")
+        environment = dict(os.environ, GREENINVOICE_HOME=os.path.join(work_directory, 'home'))
+
+        results = []
+        for name, statement in CASES.items():
+            samples = [measure(statement, work_directory, environment) for _ in range(args.repeat)]
+            results.append({
+                'case': name,
+                'ms': statistics.median(sample['ms'] for sample in samples),
+                'process_ms': statistics.median(sample['process_ms'] for sample in samples),
+                'loaded': samples[0]['loaded'],
+            })
+        return results
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup time of the CLI and GUI entry points')
+    parser.add_argument('--repeat', type=int, default=5, help='Fresh interpreters per case, the median is reported')
+    parser.add_argument('--budget-ms', type=float, default=200.0,
+                        help='Fail when a case takes longer than this, excluding interpreter start')
+    parser.add_argument('--json', default=None, help='Also write the results to this file')
+    args = parser.parse_args()
+
+    results = run_cases(args)
+    header = f"{'case':<24} {'ms':>8} {'process ms':>11}  eagerly loaded"
+    print(header)
+    print('-' * len(header))
+    failures = []
+    for result in results:
+        loaded = [name for name in result['loaded'] if name not in EXPECTED_MODULES.get(result['case'], [])]
+        print(f"{result['case']:<24} {result['ms']:>8.1f} {result['process_ms']:>11.1f}  {', '.join(loaded) or '-'}")
+        if result['ms'] > args.budget_ms:
+            failures.append(f"{result['case']} took {result['ms']:.1f}ms, budget is {args.budget_ms:.0f}ms")
+        if loaded:
+            failures.append(f"{result['case']} loaded {', '.join(loaded)} before a command needed it")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if failures:
+        print('\n'.join(failures), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import argparse
+import random
+from datetime import datetime, timedelta
+
+from openpyxl import Workbook
+
+HEADERS = ['Client', 'Date Paid', 'Amount Paid', 'Number of Apts', 'Treatment', 'Bit', 'Paybox', 'EFT', 'Cash',
+           'Bank', 'Bank Branch ', 'Account #', 'Invoice']
+PAYMENT_COLUMNS = ['Bit', 'Paybox', 'EFT', 'Cash']
+
+
+def client_names(clients):
+    return [f"Patient {index:05d}" for index in range(clients)]
+
+
+def generate_workbook(file_path, rows, clients=None, seed=0):
+    # Synthetic 'EFT & Paybox' sheet; names repeat the way a month of returning patients does
+    rng = random.Random(seed)
+    names = client_names(clients or max(1, rows // 10))
+    start = datetime(2024, 1, 1)
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('EFT & Paybox')
+    sheet.append(HEADERS)
+    for _ in range(rows):
+        paid = start + timedelta(days=rng.randrange(365))
+        appointments = rng.randint(1, 4)
+        treatments = ', '.join((paid - timedelta(days=7 * week)).strftime('%m/%d/%Y')
+                               for week in range(appointments))
+        method = rng.choice(PAYMENT_COLUMNS)
+        row = {
+            'Client': rng.choice(names),
+            'Date Paid': paid,
+            'Amount Paid': float(appointments * 350),
+            'Number of Apts': appointments,
+            'Treatment': treatments,
+            method: True,
+        }
+        if method == 'EFT':
+            row.update({'Bank': 12, 'Bank Branch ': rng.randint(100, 999), 'Account #': rng.randint(10000, 99999)})
+        sheet.append([row.get(header) for header in HEADERS])
+    workbook.save(file_path)
+    return names
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic payments workbook')
+    parser.add_argument('file', help='Path of the .xlsx file to write')
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--clients', type=int, default=None, help='Number of distinct clients (default rows / 10)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate_workbook(args.file, args.rows, args.clients, args.seed)
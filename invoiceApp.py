@@ -1,246 +1,620 @@
-import yaml
+import os
 import argparse
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from green_invoice.models import Currency, PaymentType
-from ExcelParser import ExcelParser
-from GreenInvoiceHandler import GreenInvoiceHandler
+from ColumnMapping import ColumnMapping
+from DocumentIndex import DocumentIndex
+from GreenInvoiceHandler import GreenInvoiceHandler, RequestError
+from PayloadFile import PayloadFile
+from PaymentRow import PaymentRow, RowError
+from PreviewCache import PreviewCache
+from PreviewBatch import PreviewBatch
+from Profiler import Profiler
+from RunJournal import RunJournal
+from Session import Session
 from logger import Logger
+from paths import app_directory
 
 
 def get_cli_args():
     parser = argparse.ArgumentParser(description='Invoice App CLI')
     parser.add_argument('command', choices=['checkClient', 'preview', 'generate'], help='Command to execute')
-    parser.add_argument('--file', default=None, help='Path to the input file')
+    parser.add_argument('--file', default=None, help='Path to the input file (.xlsx, .csv, .parquet or .arrow)')
+    parser.add_argument('--batch', default=None,
+                        help='Directory or glob of workbooks to process in one run instead of a single --file')
+    parser.add_argument('--parallel-files', type=int, default=2,
+                        help='Number of workbooks processed at the same time in batch mode')
+    parser.add_argument('--columns', default=None,
+                        help='YAML or JSON file mapping the app\'s fields to the headers of the input file')
+    parser.add_argument('--dry-run', default=None, metavar='PAYLOADS',
+                        help='Write the payloads generate would send to this JSONL file, without any request')
+    parser.add_argument('--replay', default=None, metavar='PAYLOADS',
+                        help='Send the documents of a --dry-run JSONL file instead of reading a workbook')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and process the rows added to --file each time it is saved')
+    parser.add_argument('--watch-interval', type=float, default=5,
+                        help='Seconds between checks of the watched file')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Read the workbook lazily in read-only mode instead of loading it up front')
+    parser.add_argument('--workers', type=int, default=1, help='Number of rows processed concurrently')
+    parser.add_argument('--rate-limit', type=float, default=None,
+                        help='Maximum API requests per second, lowered automatically while the API throttles')
+    parser.add_argument('--prefetch-clients', action='store_true',
+                        help='Load the whole client directory once before processing rows')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip rows completed by the previous run of the same command')
+    parser.add_argument('--preview-dir', default=GreenInvoiceHandler.PREVIEW_DIRECTORY,
+                        help='Directory preview PDFs are written to')
+    parser.add_argument('--preview-output', default=None,
+                        help='Collect all previews into one .zip archive or one merged .pdf file')
+    parser.add_argument('--preview-cache-mb', type=float, default=PreviewCache.MAX_BYTES / (1024 * 1024),
+                        help='Size of the cache of previews of unchanged rows, 0 turns it off')
+    parser.add_argument('--skip-reconcile', action='store_true',
+                        help='Do not check the documents already issued in the sheet\'s date range before generating')
+    parser.add_argument('--base-url', default=GreenInvoiceHandler.BASE_URL, help='Green Invoice API base URL')
+    parser.add_argument('--metrics-output', default=None,
+                        help='Write phase timings and counters to this file, Prometheus textfile format for .prom '
+                             'and JSON otherwise')
+    parser.add_argument('--profile', action='store_true',
+                        help='Capture cProfile and tracemalloc snapshots of the run into the Profiles directory')
     args = parser.parse_args()
+    if args.dry_run and args.command != 'generate':
+        parser.error("--dry-run writes the payloads of generate")
+    if args.replay and args.command != 'generate':
+        parser.error("--replay issues documents, run it with the generate command")
+    if args.batch and args.file:
+        parser.error("--batch replaces --file")
     return args
 
 
-class InvoiceApp:
+ClientProgress = namedtuple('ClientProgress', ['name', 'client_id', 'error', 'done', 'total'])
+# One per row handed to the dispatch loop, after its outcome is known; a 'started' event with row_index None
+# carries the number of rows of the run
+RowProgress = namedtuple('RowProgress', ['row_index', 'client_name', 'phase', 'ok', 'seconds', 'error', 'done',
+                                         'total'])
+
 
-    def __init__(self, command, file_path=None):
+class InvoiceApp:
+    CLIENT_WORKERS = 4
+    # Outcomes after which a row does not need to be sent again
+    COMPLETED_PHASES = ('checked', 'previewed', 'issued', 'skipped')
+
+    def __init__(self, command, file_path=None, streaming=False, workers=1, rate_limit=None,
+                 prefetch_clients=False, resume=False, preview_dir=GreenInvoiceHandler.PREVIEW_DIRECTORY,
+                 preview_output=None, base_url=GreenInvoiceHandler.BASE_URL, metrics_output=None, profile=False,
+                 session=None, reconcile=True, column_mapping=None, preview_cache_size=PreviewCache.MAX_BYTES,
+                 processed_rows=None, progress=None, cancelled=None):
         self.logger = Logger.get_logger("main")
         self.logger.info("Starting Invoice App...")
 
         self.command = command
-
-        self.key, self.secret = self.__read_cred()
-        self.green_invoice_client = GreenInvoiceHandler(self.key, self.secret)
-        self.green_invoice_client.generate_token()
-
-        if file_path:
-            self.file = ExcelParser(file_path)
-        else:
-            file_path = input("Please enter the path to the input file: ")
-            self.file = ExcelParser(file_path)
+        self.file_path = file_path
+        self.streaming = streaming
+        # Which header of the input file holds each field, a path to a mapping file or a ColumnMapping
+        if isinstance(column_mapping, str):
+            column_mapping = ColumnMapping.load(column_mapping)
+        self.column_mapping = column_mapping or ColumnMapping()
+        self.resume = resume
+        self.workers = max(1, workers)
+        self.preview_output = preview_output
+        self.preview_batch = None
+        self.reconcile = reconcile
+        # Documents already issued in the sheet's date range, built before generating
+        self.document_index = None
+        # Optional ProcessedRows, when given only new or edited rows that are not invoiced yet are sent
+        self.processed_rows = processed_rows
+        self.metrics_output = metrics_output
+        self.profile = profile
+        self.profiler = None
+
+        # A session passed in is shared with other apps and reported on by its owner
+        self.owns_session = session is None
+        # Clients are created on up to CLIENT_WORKERS connections even when rows are processed one at a time
+        self.session = session or Session(base_url=base_url, pool_size=max(self.workers, self.CLIENT_WORKERS),
+                                          rate_limit=rate_limit,
+                                          prefetch_clients=prefetch_clients, preview_dir=preview_dir,
+                                          preview_cache_size=preview_cache_size)
+        self.client_cache = self.session.client_cache
+        self.green_invoice_client = self.session.green_invoice_client
+        # Timings and counters of every phase, shared with the handler and the parser
+        self.metrics = self.session.metrics
+        # The token and the workbook are only loaded by warm_up, or by the first run
+        self.parser = None
+        self.parser_lock = threading.Lock()
+        self.journal = None
 
         self.allow_skips = True
 
-        self.client_name = None
-        self.date_paid = None
-        self.amount_paid = None
-        self.number_of_treatments = None
-        self.treatments = None
-        self.payment_method = None
-        self.invoice = None
-        self.bank_details = None
-        self.app_number = None
+        # Optional queue.Queue the RowProgress events of a run are put on, for a caller on another thread
+        self.progress = progress
+        self.progress_lock = threading.Lock()
+        self.progress_total = 0
+        # row index -> start time of the rows in flight, and row index -> phase of the rows that are done
+        self.row_started = {}
+        self.row_outcomes = {}
+        # Optional threading.Event owned by the caller, so a cancel requested before the run starts is kept
+        self.cancelled = cancelled or threading.Event()
 
         # self.run()
 
-    def run(self):
-        missing_clients = set()
-        for row_index, row_data in enumerate(self.file.data):
-            self.logger.debug(f"Starting row {row_index}")
-            self.__load_row_data(row_index)
-            self.logger.debug(f"Parsed {self.client_name} row")
-
-            if self.invoice:
-                if self.allow_skips:
-                    self.logger.debug(f"Skipping invoice {self.invoice}")
-                    continue
-                else:
-                    self.logger.critical(f"Invoice {self.invoice} already issued. Exit script")
-                    exit(-1)
+    @property
+    def file(self):
+        if self.parser is not None:
+            return self.parser
+        return self.__load_file()
+
+    def __load_file(self):
+        with self.parser_lock:
+            if self.parser is None:
+                if not self.file_path:
+                    self.file_path = input("Please enter the path to the input file: ")
+                # A session that keeps files hands back the rows it parsed for an earlier run
+                self.parser = self.session.open_file(self.file_path, streaming=self.streaming,
+                                                     mapping=self.column_mapping)
+            return self.parser
+
+    def connect(self):
+        self.session.connect()
+
+    def warm_up(self):
+        # Loads everything a run needs up front, so it can be done in the background before the run starts
+        self.connect()
+        if self.file_path:
+            self.__load_file()
+
+    def export_payloads(self, output_path):
+        # What generate would send, written without any request. Client ids come from the client cache (filled
+        # by checkClient or --prefetch-clients); rows of clients that are not cached are written without an id
+        # and resolved by name when the file is replayed.
+        rows, errors = self.__compile_rows()
+        if errors:
+            report = "\n".join(f"Row {row_index}: {error}" for row_index, error in errors.items())
+            self.logger.error("Found %s invalid rows:\n%s", len(errors), report)
+            return f"dry run not started, {len(errors)} invalid rows:\n{report}"
+
+        journal = RunJournal(f"{self.file_path}.journal", 'dryRun')
+        unresolved = set()
+        try:
+            DocumentIndex.reconcile(journal, ((row.client_name, row.date_paid, row.amount)
+                                              for row in rows if row.invoice))
+
+            def entries():
+                for row in rows:
+                    if not row.invoice:
+                        client_id, client_email = self.client_cache.get(row.client_name) or (None, None)
+                        income_list, payment_details = row.document()
+                        values = self.green_invoice_client.parse_values(client_id, payment_details, row.date_paid,
+                                                                        income_list, client_email)
+                        # Rows issued by an earlier run count as invoiced even if the write-back never landed
+                        if client_id is None or not journal.claim(journal.payload_hash(values)):
+                            if client_id is None:
+                                unresolved.add(row.client_name)
+                            yield {'row': row.row_index, 'client': row.client_name, 'values': values}
+                            continue
+                    # Only what identifies its document, which a replay accounts for before sending
+                    yield {'row': row.row_index, 'client': row.client_name, 'date': row.date_paid,
+                           'amount': row.amount, 'invoiced': True}
+
+            exported = PayloadFile(output_path).write(entries(), source=os.path.abspath(self.file_path))
+        finally:
+            journal.close()
+        self.logger.info("Wrote %s payloads to %s, %s clients to resolve on replay", exported, output_path,
+                         len(unresolved))
+        result = f"dry run wrote {exported} payloads to {output_path}"
+        if unresolved:
+            result += f", {len(unresolved)} clients are not cached and are looked up on replay"
+        return result
+
+    def cancel(self):
+        # No new row is sent once this is set; requests already sent are finished and recorded
+        self.cancelled.set()
 
-            result = self.green_invoice_client.search_client_by_name(self.client_name)
-            if result:
-                client_id, client_email = result
-            else:
-                client_id, client_email = None, None
+    def run(self):
+        if self.profile:
+            time_stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            self.profiler = Profiler(os.path.join(app_directory('Profiles'), f"{self.command}_{time_stamp}"))
+            self.profiler.start()
+        self.session.connect_or_exit()
+        file = self.file
+        # Per-row outcomes of every run on this workbook, used to resume and to never issue a document twice
+        self.journal = RunJournal(f"{self.file_path}.journal", self.command, resume=self.resume)
+        try:
+            with self.metrics.time('run'):
+                return self.__run_rows()
+        finally:
+            file.flush()
+            self.session.save()
+            self.journal.close()
+            if self.profiler:
+                self.profiler.stop()
+                self.profiler = None
+            if self.owns_session:
+                self.session.report(self.metrics_output)
+
+    def __run_rows(self):
+        if self.command not in ('checkClient', 'preview', 'generate'):
+            self.logger.error("Unknown command: %s", self.command)
+            print(f"Unknown command: {self.command}. Exiting...")
+            exit(-1)
 
-            if client_id is None:
-                self.logger.warning(f"Client {self.client_name} not found")
-                missing_clients.add(self.client_name)
-                if self.command != 'checkClient':
-                    exit(-1)
+        rows, errors = self.__compile_rows()
+        if errors:
+            report = "\n".join(f"Row {row_index}: {error}" for row_index, error in errors.items())
+            self.logger.error("Found %s invalid rows:\n%s", len(errors), report)
+            if self.command != 'checkClient':
+                return f"{self.command} not started, {len(errors)} invalid rows:\n{report}"
+
+        pending = rows
+        if self.processed_rows is not None:
+            pending = [row for row in rows if not row.invoice and self.processed_rows.changed(row)]
+            self.metrics.count('rows_unchanged', len(rows) - len(pending))
+            self.logger.info("%s new or edited rows to %s", len(pending), self.command)
+
+        self.document_index = None
+        if self.command == 'generate':
+            try:
+                self.document_index = DocumentIndex.reconcile(
+                    self.journal, ((row.client_name, row.date_paid, row.amount) for row in rows if row.invoice),
+                    dates=(row.date_paid for row in pending if not row.invoice),
+                    search_documents=self.green_invoice_client.search_documents if self.reconcile else None)
+            except RequestError as e:
+                # Without the issued documents a re-run could issue a row twice
+                self.logger.error("Could not fetch issued documents: %s", e)
+                return f"{self.command} not started, could not fetch issued documents: {e}"
 
+        missing_clients = set()
+        failed_rows = {}
+        with self.progress_lock:
+            self.progress_total = len(pending)
+            self.row_started = {}
+            self.row_outcomes = {}
+        if self.progress is not None:
+            self.progress.put(RowProgress(None, None, 'started', True, 0.0, None, 0, len(pending)))
+        if self.command == 'preview' and self.preview_output:
+            self.preview_batch = PreviewBatch(self.preview_output)
+        try:
+            if self.workers > 1:
+                self.__run_concurrent(pending, missing_clients, failed_rows)
             else:
-                income_list = self.__construct_income_list()
-                payment_details = self.__construct_payment_details()
-                values = self.green_invoice_client.parse_values(client_id, payment_details, self.date_paid,
-                                                                income_list, client_email)
-
-                if self.command == 'preview':
-                    self.green_invoice_client.generate_new_invoice_preview(values, self.client_name)
-                elif self.command == 'generate':
-                    self.__handle_generate(row_index, values)
-                elif self.command == 'checkClient':
-                    pass
-                else:
-                    self.logger.error(f"Unknown command: {self.command}")
-                    print(f"Unknown command: {self.command}. Exiting...")
-                    exit(-1)
-        if missing_clients:
+                self.__run_sequential(pending, missing_clients, failed_rows)
+        finally:
+            if self.preview_batch:
+                self.preview_batch.close()
+                self.preview_batch = None
+
+        if self.processed_rows is not None:
+            # Failed rows, rows of missing clients and rows never reached are tried again by the next run
+            self.processed_rows.mark(row for row in pending
+                                     if self.row_outcomes.get(row.row_index) in self.COMPLETED_PHASES)
+            self.processed_rows.save()
+
+        if missing_clients and self.command == 'checkClient':
             return missing_clients
+        elif self.cancelled.is_set():
+            self.logger.warning("Cancelled after %s of %s rows", len(self.row_outcomes), len(pending))
+            failed = f", {len(failed_rows)} failed" if failed_rows else ""
+            return f"{self.command} cancelled after {len(self.row_outcomes)} of {len(pending)} rows{failed}"
+        elif failed_rows:
+            rows = ", ".join(str(row_index) for row_index in sorted(failed_rows))
+            self.logger.warning("Finished processing with %s failed rows: %s", len(failed_rows), rows)
+            return f"{self.command} completed with {len(failed_rows)} failed rows: {rows}"
         else:
             self.logger.info("Finished processing all rows")
             return self.command + " completed successfully"
 
-    def __handle_generate(self, row_index, values):
-        self.green_invoice_client.generate_new_invoice(values, self.client_name)
-        self.file.change_invoice_status(row_index)
-        self.allow_skips = False
-        self.logger.debug(f"Allowing skips: {self.allow_skips}")
-
-    def handle_missing_clients(self, missing_clients):
-        self.green_invoice_client.add_client(missing_clients)
-
-    def __load_row_data(self, row_index):
+    def __run_sequential(self, rows, missing_clients, failed_rows):
+        for row in rows:
+            if self.cancelled.is_set():
+                break
+            if not self.__should_dispatch(row):
+                self.metrics.count('rows_skipped')
+                self.__report_row(row, 'skipped')
+                continue
+            self.__start_row(row)
+            try:
+                result = self.green_invoice_client.search_client_by_name(row.client_name)
+                values = self.__build_values(row, result, missing_clients)
+            except (RowError, RequestError) as e:
+                self.__fail_row(row, failed_rows, e)
+                continue
+            if values is None:
+                continue
+            try:
+                self.__handle_dispatch(row, values, self.__dispatch(row, values))
+            except (RowError, RequestError) as e:
+                self.__fail_row(row, failed_rows, e, values)
+
+    def __run_concurrent(self, rows, missing_clients, failed_rows):
+        # Client lookups run ahead on the pool; their results are consumed in row order, and only then is the
+        # preview/document request for that row submitted. Issued documents are committed in row order too.
+        lookups = deque()
+        dispatches = deque()
+        # Rows of the same client share a single lookup
+        client_lookups = {}
+        window = self.workers * 2
+        initializer = self.profiler.enable_thread if self.profiler else None
+        with ThreadPoolExecutor(max_workers=self.workers, initializer=initializer) as executor:
+            try:
+                for row in rows:
+                    if row.invoice and self.command == 'generate':
+                        # Whether an invoiced row is out of order depends on the rows before it being issued,
+                        # so they are all committed first, as in a sequential run
+                        while lookups and not self.cancelled.is_set():
+                            self.__commit_lookup(executor, lookups, dispatches, missing_clients, failed_rows)
+                        while dispatches:
+                            self.__commit_dispatch(dispatches, failed_rows)
+                    if self.cancelled.is_set():
+                        break
+                    if not self.__should_dispatch(row):
+                        self.metrics.count('rows_skipped')
+                        self.__report_row(row, 'skipped')
+                        continue
+                    self.__start_row(row)
+
+                    lookup = client_lookups.get(row.client_name)
+                    if lookup is None:
+                        lookup = executor.submit(self.green_invoice_client.search_client_by_name, row.client_name)
+                        client_lookups[row.client_name] = lookup
+                    lookups.append((row, lookup))
+
+                    while len(lookups) >= window:
+                        self.__commit_lookup(executor, lookups, dispatches, missing_clients, failed_rows)
+                    while dispatches and (len(dispatches) >= window or dispatches[0][-1].done()):
+                        self.__commit_dispatch(dispatches, failed_rows)
+
+                # Rows whose client was looked up are not sent once the run is cancelled
+                while lookups and not self.cancelled.is_set():
+                    self.__commit_lookup(executor, lookups, dispatches, missing_clients, failed_rows)
+                while dispatches:
+                    self.__commit_dispatch(dispatches, failed_rows)
+            finally:
+                for _, lookup in lookups:
+                    lookup.cancel()
+                # Documents that were already issued must be recorded even if the run is aborted
+                while dispatches:
+                    try:
+                        self.__commit_dispatch(dispatches, failed_rows)
+                    except Exception as e:
+                        self.logger.error("Row failed while aborting the run: %s", e)
+
+    def __commit_lookup(self, executor, lookups, dispatches, missing_clients, failed_rows):
+        row, lookup = lookups.popleft()
         try:
-            row_data = self.file.get_row(row_index)
-        except Exception as e:
-            self.logger.error(f"Error in parsing data: {e}")
-            exit(-1)
+            values = self.__build_values(row, lookup.result(), missing_clients)
+        except (RowError, RequestError) as e:
+            self.__fail_row(row, failed_rows, e)
+            return
+        if values is not None:
+            dispatches.append((row, values, executor.submit(self.__dispatch, row, values)))
+
+    def __commit_dispatch(self, dispatches, failed_rows):
+        row, values, dispatch = dispatches.popleft()
         try:
-            self.client_name = self.file.get_cell(row_data, 'Client')
-            self.date_paid = self.__convert_date_paid(self.file.get_cell(row_data, 'Date Paid'))
-            self.amount_paid = self.file.get_cell(row_data, 'Amount Paid')
-            self.number_of_treatments = self.file.get_cell(row_data, 'Number of Apts')
-            self.treatments = self.__convert_treatments_date(self.file.get_cell(row_data, 'Treatment'))
-            self.bank_details = [self.file.get_cell(row_data, 'Bank'), self.file.get_cell(row_data, 'Bank Branch '),
-                                 self.file.get_cell(row_data, 'Account #')]
-            self.invoice = self.file.get_cell(row_data, 'Invoice')
-            self.__get_payment_method(row_data)
-        except Exception as e:
-            self.logger.error(f"Error in parsing data: {e}")
-            exit(-1)
-
-    def __convert_date_paid(self, date_paid):
-        self.logger.debug(f"Converting date_paid: {date_paid}")
-        try:
-            if date_paid:
-                return date_paid.strftime("%Y-%m-%d")
+            self.__handle_dispatch(row, values, dispatch.result())
+        except (RowError, RequestError) as e:
+            self.__fail_row(row, failed_rows, e, values)
+
+    def __compile_rows(self):
+        # Every row is parsed and its document built before any request goes out, so all invalid rows are
+        # reported together instead of surfacing one at a time in the middle of a run
+        rows = []
+        errors = {}
+        columns = PaymentRow.columns(self.file)
+        for row_index, row_data in self.file.iter_rows():
+            self.logger.debug("Compiling row %s", row_index)
+            with self.metrics.time('row_parse'):
+                row = PaymentRow.parse(row_index, row_data, columns)
+                # Already invoiced rows are never sent, so their content is not validated
+                if not row.invoice:
+                    try:
+                        # Only checked here; the document is built again when the row is sent, so the
+                        # compiled rows stay small
+                        row.document()
+                    except RowError as e:
+                        errors[row_index] = e
+                    except Exception as e:
+                        errors[row_index] = RowError(f"Could not build the document: {e}")
+            if row_index in errors:
+                self.metrics.count('rows_invalid')
+            rows.append(row)
+        return rows, errors
+
+    def __should_dispatch(self, row):
+        self.logger.debug("Starting row %s", row.row_index)
+        # A row issued by an earlier run whose write-back never landed is recognised by its payload once its
+        # client is looked up, or by the issued documents matched while reconciling
+        if row.invoice:
+            if self.allow_skips:
+                self.logger.debug("Skipping invoice %s", row.invoice)
+                return False
             else:
-                return None
-        except AttributeError as e:
-            self.logger.error(f"Could not convert date_paid: {e}")
-            return None
-
-    def __convert_treatments_date(self, treatments_date):
-        try:
-            if isinstance(treatments_date, datetime):
-                treatments_date = treatments_date.strftime('%m/%d/%Y')
-
-            if not isinstance(treatments_date, str):
-                self.logger.error("treatments_date is not a string")
+                self.logger.critical("Invoice %s already issued. Exit script", row.invoice)
                 exit(-1)
 
-            # Split the dates and format them
-            dates = treatments_date.split(',')
-            formatted_dates = [datetime.strptime(date.strip(), '%m/%d/%Y').strftime('%Y-%m-%d') for date in dates]
-        except Exception as e:
-            formatted_dates = []
-            self.logger.error(f"An error occurred while converting treatment dates: {e}")
-        return formatted_dates
-
-    def __get_payment_method(self, row_data):
-        bit = self.file.get_cell(row_data, 'Bit')
-        paybox = self.file.get_cell(row_data, 'Paybox')
-        eft = self.file.get_cell(row_data, 'EFT')
-        cash = self.file.get_cell(row_data, 'Cash')
-        if bit:
-            self.payment_method = PaymentType.PAYMENT_APP
-            self.app_number = 1
-        elif paybox:
-            self.payment_method = PaymentType.PAYMENT_APP
-            self.app_number = 3
-        elif eft:
-            self.payment_method = PaymentType.ELECTRONIC_FUND_TRANSFER
-        elif cash:
-            self.payment_method = PaymentType.CASH
-
-        else:
-            self.logger.debug(f"name: {self.client_name}")
-            self.logger.error("No payment method found")
-            exit(-1)
-
-    def __construct_income_list(self):
-        income_list = []
-        for i in range(int(self.number_of_treatments)):
-            description = f"Physiotherapy - {self.treatments[i]}"
-            income_list.append(
-                {
-                    "catalogNum": "Physiotherapy session",
-                    'description': description,
-                    'quantity': 1,
-                    'price': self.amount_paid / self.number_of_treatments,
-                    'currency': Currency.ILS,
-                    'vatType': 1,
-                }
-            )
-        return income_list
-
-    def __construct_payment_details(self):
-
-        price = self.amount_paid
-
-        payment_details = {
-            'date': self.date_paid,
-            'type': self.payment_method,
-            'price': price,
-            'currency': Currency.ILS,
-            'dueDate': self.date_paid,
-        }
-
-        if self.payment_method == PaymentType.PAYMENT_APP:
-            if self.app_number == 1:
-                payment_details.update({
-                    'appType': 1
-                })
-            elif self.app_number == 3:
-                payment_details.update({
-                    'appType': 3
-                })
-        elif self.payment_method == PaymentType.ELECTRONIC_FUND_TRANSFER:
-            payment_details.update({
-                'bankName': str(self.bank_details[0]),
-                'bankBranch': str(self.bank_details[1]),
-                'bankAccount': str(self.bank_details[2]),
-            })
-        elif self.payment_method == PaymentType.CASH:  # Cash
-            pass
-
+        # Issued rows are only recognised by their payload, a resumed generate sends every other row again
+        if self.command != 'generate' and self.journal.is_completed(row.row_index, row.client_name):
+            self.logger.debug("Skipping row %s, completed by the resumed run", row.row_index)
+            return False
+
+        if self.document_index is not None and self.document_index.claim_issued(
+                self.journal, row.row_index, row.client_name, row.date_paid, row.amount):
+            self.file.change_invoice_status(row.row_index)
+            self.metrics.count('rows_reconciled')
+            return False
+        return True
+
+    def __build_values(self, row, result, missing_clients):
+        if result:
+            client_id, client_email = result
         else:
-            self.logger.error(f"Unknown payment method: {self.payment_method}")
-            exit(-1)
-        return [payment_details]
+            client_id, client_email = None, None
+
+        if client_id is None:
+            self.logger.warning("Client %s not found", row.client_name)
+            missing_clients.add(row.client_name)
+            self.metrics.count('rows_missing_client')
+            if self.command != 'checkClient':
+                raise RowError(f"Client {row.client_name} not found")
+            self.journal.record(row.row_index, 'missing client', client=row.client_name)
+            self.__report_row(row, 'missing client', f"Client {row.client_name} not found")
+            return None
 
-    def __read_cred(self, file_path="Samples/Credentials.yml"):
-        try:
-            with open(file_path, 'r') as f:
-                creds = yaml.safe_load(f)
+        income_list, payment_details = row.document()
+        values = self.green_invoice_client.parse_values(client_id, payment_details, row.date_paid,
+                                                        income_list, client_email)
 
-            key = creds.get('key')
-            secret = creds.get('secret')
+        if self.command == 'checkClient':
+            self.journal.record(row.row_index, 'checked', client=row.client_name, client_id=client_id)
+            self.metrics.count('rows_done')
+            self.__report_row(row, 'checked')
+            return None
 
-            return key, secret
-        except FileNotFoundError as fileNotFoundErr:
-            self.logger.error(f"error in opening cred file: {fileNotFoundErr}")
-            exit(-1)
-        except:
-            self.logger.error(f"Unexpected error in opening file: {file_path}")
-            exit(-1)
+        if self.command == 'generate':
+            issued = self.journal.begin_send(row.row_index, self.journal.payload_hash(values),
+                                             client=row.client_name, client_id=client_id)
+            if issued:
+                self.logger.warning("Row %s matches document %s issued from row %s, not issuing it again",
+                                    row.row_index, issued.get('document_id'), issued['row'])
+                self.file.change_invoice_status(row.row_index)
+                self.__report_row(row, 'skipped')
+                return None
+        return values
 
-# if __name__ == "__main__":
-# args = get_cli_args()
-# app = InvoiceApp(command=args.command, file_path=args.file)
+    def __dispatch(self, row, values):
+        if self.command == 'preview':
+            if self.preview_batch:
+                output_filepath = self.preview_batch.staging_path(row.row_index)
+            else:
+                output_filepath = self.green_invoice_client.preview_path(row.client_name, row.row_index)
+            return self.green_invoice_client.generate_new_invoice_preview(values, row.client_name, output_filepath)
+        # Journaled by the worker as soon as the answer arrives, so a row waiting in begin_send for the same
+        # payload is never held up by the rows committed before it
+        return self.journal.send(row.row_index, self.journal.payload_hash(values),
+                                 lambda: self.green_invoice_client.generate_new_invoice(values, row.client_name),
+                                 client=row.client_name, client_id=values['client']['id'], date=row.date_paid,
+                                 amount=row.amount)
+
+    def __handle_dispatch(self, row, values, document):
+        if self.command == 'generate':
+            self.__handle_generate(row)
+        else:
+            if self.preview_batch:
+                # Handed over in row order, so the batch follows the sheet
+                self.preview_batch.add(document, row.row_index, row.client_name, values['payment'][0]['price'])
+            self.journal.record(row.row_index, 'previewed', client=row.client_name,
+                                client_id=values['client']['id'], payload_hash=self.journal.payload_hash(values))
+        self.metrics.count('rows_done')
+        self.__report_row(row, 'issued' if self.command == 'generate' else 'previewed')
+
+    def __handle_generate(self, row):
+        self.file.change_invoice_status(row.row_index)
+        self.allow_skips = False
+        self.logger.debug("Allowing skips: %s", self.allow_skips)
+
+    def __fail_row(self, row, failed_rows, error, values=None):
+        self.logger.error("Row %s (%s) failed: %s", row.row_index, row.client_name, error)
+        failed_rows[row.row_index] = str(error)
+        self.metrics.count('rows_failed')
+        # A failed document request was journaled when it was sent
+        if values is None or self.command != 'generate':
+            self.journal.record(row.row_index, 'failed', client=row.client_name, error=error)
+        self.__report_row(row, 'failed', error)
+
+    def __start_row(self, row):
+        with self.progress_lock:
+            self.row_started[row.row_index] = time.perf_counter()
+
+    def __report_row(self, row, phase, error=None):
+        with self.progress_lock:
+            started = self.row_started.pop(row.row_index, None)
+            self.row_outcomes[row.row_index] = phase
+            done = len(self.row_outcomes)
+        seconds = time.perf_counter() - started if started is not None else 0.0
+        if started is not None:
+            self.metrics.observe('row', seconds)
+        if self.progress is not None:
+            self.progress.put(RowProgress(row.row_index, row.client_name, phase, phase in self.COMPLETED_PHASES,
+                                          seconds, None if error is None else str(error), done,
+                                          self.progress_total))
+
+    def add_clients(self, client_names, progress=None):
+        # Clients are created concurrently, and each outcome is put on the `progress` queue as it arrives,
+        # so a caller on another thread (the GUI) can follow along without blocking
+        client_names = sorted(set(client_names))
+        created = {}
+        failed = {}
+        if not client_names:
+            return created, failed
+        self.logger.info("Adding %s clients", len(client_names))
+        with ThreadPoolExecutor(max_workers=min(self.CLIENT_WORKERS, len(client_names))) as executor:
+            futures = {executor.submit(self.green_invoice_client.add_client, name): name for name in client_names}
+            for done, future in enumerate(as_completed(futures), 1):
+                name = futures[future]
+                try:
+                    client_id = future.result()
+                    error = None if client_id else "the response has no client id"
+                except RequestError as e:
+                    client_id, error = None, str(e)
+                if client_id:
+                    created[name] = client_id
+                    self.metrics.count('clients_created')
+                else:
+                    self.logger.error("Could not add client %s: %s", name, error)
+                    failed[name] = error
+                    self.metrics.count('clients_failed')
+                if progress is not None:
+                    progress.put(ClientProgress(name, client_id, error, done, len(client_names)))
+        self.client_cache.save()
+        return created, failed
+
+
+def main():
+    args = get_cli_args()
+    preview_cache_size = int(args.preview_cache_mb * 1024 * 1024)
+    if args.replay:
+        from Replayer import Replayer
+        replayer = Replayer(args.replay, workers=args.workers, rate_limit=args.rate_limit,
+                            prefetch_clients=args.prefetch_clients, base_url=args.base_url,
+                            metrics_output=args.metrics_output)
+        print(replayer.run())
+    elif args.watch:
+        from Watcher import Watcher
+        watcher = Watcher(args.command, args.file, interval=args.watch_interval, streaming=args.streaming,
+                          workers=args.workers, rate_limit=args.rate_limit, prefetch_clients=args.prefetch_clients,
+                          preview_dir=args.preview_dir, base_url=args.base_url, metrics_output=args.metrics_output,
+                          reconcile=not args.skip_reconcile, column_mapping=args.columns,
+                          preview_cache_size=preview_cache_size)
+        watcher.run()
+    elif args.batch:
+        from BatchRunner import BatchRunner
+        batch = BatchRunner(args.command, args.batch, parallel_files=args.parallel_files, streaming=args.streaming,
+                            workers=args.workers, rate_limit=args.rate_limit, prefetch_clients=args.prefetch_clients,
+                            resume=args.resume, preview_dir=args.preview_dir, preview_output=args.preview_output,
+                            base_url=args.base_url, metrics_output=args.metrics_output,
+                            reconcile=not args.skip_reconcile, column_mapping=args.columns,
+                            preview_cache_size=preview_cache_size)
+        batch.run()
+        missing_clients = batch.missing_clients()
+        if missing_clients:
+            print(f"{len(missing_clients)} missing clients: {', '.join(sorted(missing_clients))}")
+    else:
+        app = InvoiceApp(command=args.command, file_path=args.file, streaming=args.streaming, workers=args.workers,
+                         rate_limit=args.rate_limit, prefetch_clients=args.prefetch_clients, resume=args.resume,
+                         preview_dir=args.preview_dir, preview_output=args.preview_output, base_url=args.base_url,
+                         metrics_output=args.metrics_output, profile=args.profile,
+                         reconcile=not args.skip_reconcile, column_mapping=args.columns,
+                         preview_cache_size=preview_cache_size)
+        if args.dry_run:
+            print(app.export_payloads(args.dry_run))
+            return
+        result = app.run()
+        if isinstance(result, set):
+            result = f"{len(result)} missing clients: {', '.join(sorted(result))}"
+        print(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,93 @@
+import atexit
+import gzip
 import logging
+import logging.handlers
 import os
-from datetime import datetime
+import queue
+import shutil
+
+from paths import app_directory
+
 
 class Logger:
+    LOG_FILE = 'greeninvoice.log'
+    MAX_BYTES = 10 * 1024 * 1024
+    BACKUP_COUNT = 10
+    # Level for every subsystem, and per-subsystem overrides such as "GreenInvoiceHandler=DEBUG,ExcelParser=WARNING"
+    DEFAULT_LEVEL = os.environ.get('GREENINVOICE_LOG_LEVEL', 'INFO')
+    LEVELS = os.environ.get('GREENINVOICE_LOG_LEVELS', '')
+    # 'size' rotates at MAX_BYTES, 'daily' at midnight; rotated files are gzipped
+    ROTATION = os.environ.get('GREENINVOICE_LOG_ROTATION', 'size')
+
+    __queue_handler = None
+    __listener = None
+
     @staticmethod
     def get_logger(module_name):
-        current_date_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-
         logger = logging.getLogger(module_name)
-        logger.setLevel(logging.DEBUG)
+        logger.setLevel(Logger.level_for(module_name))
 
         if not logger.hasHandlers():
-            # Setting up a generic location - user's home directory
-            log_directory = os.path.join(os.path.expanduser('~'), 'GreenInvoiceHandler_', 'Logs')
-            os.makedirs(log_directory, exist_ok=True)  # Create the log directory if it doesn't exist
+            # Records are only put on a queue here; a single listener thread writes them, so disk I/O stays
+            # off the request path
+            logger.addHandler(Logger.__get_queue_handler())
 
-            # Log file path
-            log_file_path = os.path.join(log_directory, f"log_{current_date_time}.log")
+        return logger
 
-            # Creating the FileHandler
-            handler = logging.FileHandler(log_file_path)
-            handler.setLevel(logging.DEBUG)
+    @staticmethod
+    def level_for(module_name):
+        for override in Logger.LEVELS.split(','):
+            name, _, level = override.partition('=')
+            if name.strip() == module_name and level.strip():
+                return level.strip().upper()
+        return Logger.DEFAULT_LEVEL.upper()
 
-            # Setting the format for the log messages
-            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                                          datefmt='%d-%m-%y %H:%M:%S')
-            handler.setFormatter(formatter)
+    @staticmethod
+    def shutdown():
+        if Logger.__listener is not None:
+            Logger.__listener.stop()
+            Logger.__listener = None
 
-            # Adding the handler to the logger
-            logger.addHandler(handler)
+    @staticmethod
+    def __get_queue_handler():
+        if Logger.__queue_handler is None:
+            log_queue = queue.SimpleQueue()
+            # The message and any traceback are rendered before queueing, so a record never shows an argument
+            # changed after the call or keeps its frames alive; records below the level never reach the handler
+            Logger.__queue_handler = logging.handlers.QueueHandler(log_queue)
+            Logger.__listener = logging.handlers.QueueListener(log_queue, Logger.__file_handler(),
+                                                               respect_handler_level=True)
+            Logger.__listener.start()
+            # Drain whatever is still queued when the process exits
+            atexit.register(Logger.shutdown)
+        return Logger.__queue_handler
 
-        return logger
+    @staticmethod
+    def __file_handler():
+        log_file_path = os.path.join(app_directory('Logs'), Logger.LOG_FILE)
+
+        if Logger.ROTATION == 'daily':
+            handler = logging.handlers.TimedRotatingFileHandler(log_file_path, when='midnight',
+                                                                backupCount=Logger.BACKUP_COUNT)
+        else:
+            handler = logging.handlers.RotatingFileHandler(log_file_path, maxBytes=Logger.MAX_BYTES,
+                                                           backupCount=Logger.BACKUP_COUNT)
+        handler.namer = Logger.__compressed_name
+        handler.rotator = Logger.__compress
+        handler.setLevel(logging.DEBUG)
+
+        # Setting the format for the log messages
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                                      datefmt='%d-%m-%y %H:%M:%S')
+        handler.setFormatter(formatter)
+        return handler
+
+    @staticmethod
+    def __compressed_name(name):
+        return name + '.gz'
+
+    @staticmethod
+    def __compress(source, destination):
+        with open(source, 'rb') as f_in, gzip.open(destination, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
@@ -1,11 +1,8 @@
-from GreenInvoiceHandler import GreenInvoiceHandler
-from invoiceApp import InvoiceApp
-from logger import Logger
+import invoiceApp
 
 
 def main():
-    invoiceApp = InvoiceApp()
-
+    invoiceApp.main()
 
 
 if __name__ == '__main__':
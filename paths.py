@@ -0,0 +1,27 @@
+import os
+import threading
+from contextlib import contextmanager
+
+# Generic location for everything the app keeps between runs - user's home directory,
+# can be moved with GREENINVOICE_HOME (e.g. to keep benchmarks away from the real caches)
+APP_DIRECTORY = os.environ.get('GREENINVOICE_HOME') or os.path.join(os.path.expanduser('~'), 'GreenInvoiceHandler_')
+
+
+def app_directory(*parts):
+    directory = os.path.join(APP_DIRECTORY, *parts)
+    os.makedirs(directory, exist_ok=True)  # Create the directory if it doesn't exist
+    return directory
+
+
+@contextmanager
+def replaced_atomically(path):
+    # Yields a temporary path next to `path`, swapped in once it was written completely, so a crash or an error
+    # mid-write never leaves a half written file behind. The thread id keeps concurrent writers apart.
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
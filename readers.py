@@ -0,0 +1,26 @@
+import os
+
+CSV_EXTENSIONS = ('.csv', '.tsv')
+ARROW_EXTENSIONS = ('.parquet', '.pq', '.arrow', '.feather')
+EXCEL_EXTENSIONS = ('.xlsx',)
+SUPPORTED_EXTENSIONS = EXCEL_EXTENSIONS + CSV_EXTENSIONS + ARROW_EXTENSIONS
+
+
+def reader_for(file_path):
+    # Readers are imported on demand, so only the one the file needs is loaded
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension in CSV_EXTENSIONS:
+        from CsvReader import CsvReader
+        return CsvReader
+    if extension in ARROW_EXTENSIONS:
+        from ArrowReader import ArrowReader
+        return ArrowReader
+    from ExcelParser import ExcelParser
+    return ExcelParser
+
+
+def open_reader(file_path, streaming=False, metrics=None, mapping=None):
+    reader = reader_for(file_path)
+    # Only workbooks are large enough on disk to be worth streaming
+    return reader(file_path, streaming=streaming and reader.__name__ == 'ExcelParser', metrics=metrics,
+                  mapping=mapping)